@@ -0,0 +1,51 @@
+import os
+import json
+import time
+
+
+class Checkpoint:
+    """Progress of a job, saved to a small JSON file so that it can be resumed
+after an interruption. Updates are written at most once every minInterval
+seconds, as they come with every acknowledged packet."""
+    def __init__(self, filename, minInterval=1.):
+        self.filename = filename
+        self.minInterval = minInterval
+        self.lastWrite = 0
+        self.state = None
+
+    def update(self, state, force=False):
+        self.state = state
+        now = time.time()
+        if force or now - self.lastWrite >= self.minInterval:
+            self.write()
+            self.lastWrite = now
+
+    def write(self):
+        if self.state is None:
+            return
+        # Replace the file atomically, an interruption must not corrupt it
+        tmp = self.filename + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump(self.state, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+
+    def load(self):
+        """Return the saved state, or None if there is none"""
+        try:
+            f = open(self.filename, "r")
+        except IOError:
+            return None
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+        finally:
+            f.close()
+
+    def clear(self):
+        self.state = None
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
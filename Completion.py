@@ -0,0 +1,88 @@
+import threading
+import time
+
+
+class CompletionFuture:
+    """Result of an asynchronous wait for the machine to finish its moves."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._error = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Block until the machine is finished or the timeout expires.
+Returns True if the machine is finished, and raises the error that
+interrupted the wait, if any."""
+        if not self._event.wait(timeout):
+            return False
+        if self._error is not None:
+            raise self._error
+        return True
+
+    def addDoneCallback(self, callback):
+        """Call callback(future) once the wait is over, immediately if it already is."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, error=None):
+        with self._lock:
+            self._error = error
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class CompletionWaiter:
+    """Waits for the machine to finish its queued moves without flooding the
+serial line : if the moves are expected to last for some time, sleep until
+shortly before their estimated end, then poll IS_FINISHED with an increasing
+delay between queries."""
+    def __init__(self, isFinished, minDelay=0.005, maxDelay=0.1, backoff=1.5):
+        self.isFinished = isFinished
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.queries = 0
+
+    def wait(self, estimate=None):
+        """Block until the machine is finished.
+estimate is the time (as returned by time.time()) at which the queued moves
+are expected to be over, or None if unknown."""
+        if estimate is not None:
+            remaining = estimate - time.time() - self.maxDelay
+            if remaining > 0:
+                time.sleep(remaining)
+        delay = self.minDelay
+        while True:
+            self.queries += 1
+            if self.isFinished():
+                return
+            time.sleep(delay)
+            delay = min(delay * self.backoff, self.maxDelay)
+
+    def waitAsync(self, estimate=None, callback=None):
+        """Wait in a background thread and return a CompletionFuture.
+If given, callback(future) is called when the machine is finished."""
+        future = CompletionFuture()
+        if callback is not None:
+            future.addDoneCallback(callback)
+        def run():
+            try:
+                self.wait(estimate)
+            except Exception as e:
+                future._finish(e)
+            else:
+                future._finish()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return future
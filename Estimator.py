@@ -0,0 +1,62 @@
+import Toolpath
+import Makerbot
+import JobCompiler
+
+
+class LayerStats:
+    """Statistics of a layer, or of a whole job : lengths in mm, duration in seconds"""
+    def __init__(self):
+        self.cutLength = 0
+        self.travelLength = 0
+        self.plunges = 0
+        self.packets = 0
+        self.duration = 0
+
+    def add(self, stats):
+        self.cutLength += stats.cutLength
+        self.travelLength += stats.travelLength
+        self.plunges += stats.plunges
+        self.packets += stats.packets
+        self.duration += stats.duration
+
+
+class Estimator:
+    """Simulates the making of a layer the way cmd_run does it, without a
+machine : the moves are the ones the JobCompiler generates for a machine with
+the profile of machineName, in classic or accelerated mode, so that each order
+lasts as long as the packet sent for it."""
+    def __init__(self, speeds, machineName="The Replicator 2", accelerated=False, travelHeight=3):
+        self.machine = Makerbot.Makerbot()
+        self.machine.loadProfile(machineName)
+        self.machine.accelerated = accelerated
+        self.compiler = JobCompiler.JobCompiler(self.machine, speeds)
+        self.travelHeight = travelHeight
+
+    def estimateLayer(self, toolpath, start=(0, 0)):
+        """Return the LayerStats of a toolpath, starting from start with the
+tool at travelHeight"""
+        stats = LayerStats()
+        stats.packets = len(toolpath)
+        # The durations do not depend on the height of the buildplate as long
+        # as the moves stay within the Z range of the machine
+        buildplateZ = self.machine.amplitude['z'] / 2.
+        position = {'x' : start[0], 'y' : start[1], 'z' : buildplateZ - self.travelHeight}
+        offset = {'x' : 0, 'y' : 0}
+
+        ops = toolpath.op
+        zs = toolpath.z
+        up = True
+        for i, steps, speed, duration, distance in self.compiler.moves(toolpath, offset, buildplateZ, False, 0, position):
+            stats.duration += duration
+            if ops[i] == Toolpath.MOVE_XY:
+                if up:
+                    stats.travelLength += distance
+                else:
+                    stats.cutLength += distance
+            elif zs[i] > 0:
+                up = True
+            else:
+                if up:
+                    stats.plunges += 1
+                up = False
+        return stats
@@ -0,0 +1,90 @@
+import Makerbot
+import JobCompiler
+
+
+class JobExporter:
+    """Writes a job to a .s3g or .x3g file, to be played from the SD card of
+the machine without depending on the host. The homing, position offset,
+board reversal and buildplate heights are resolved when exporting, so the
+file holds the same moves cmd_run would send, with the operator's actions
+(tool change, turning the board, starting the motor) asked on the machine's
+screen. The .x3g files use accelerated moves, with the speeds limited to the
+max_feedrate of the axes."""
+    def __init__(self, filename, speeds, travelHeight=3, reversedOriginX=71, machineName="The Replicator 2"):
+        self.mb = Makerbot.Makerbot()
+        self.mb.openFile(filename, machineName)
+        self.compiler = JobCompiler.JobCompiler(self.mb, speeds)
+        self.travelHeight = travelHeight
+        self.reversedOriginX = reversedOriginX
+
+    def message(self, text):
+        # Display a message and pause until the center button is pressed
+        self.mb.flush()
+        self.mb.driver.display_message(0, 0, text, 0, True, True, False)
+        self.mb.driver.wait_for_button('center', 0, False, False, True)
+
+    def export(self, name, layers, offset, bounds, buildplateZ):
+        """Write the job and close the file.
+layers is a list of (layerId, toolpath, tool description, reversed), bounds
+the [minX, minY, maxX, maxY] of the project, and buildplateZ the height of the
+buildplate touching each tool, by tool description."""
+        mb = self.mb
+        driver = mb.driver
+        driver.build_start_notification(str(name))
+
+        # Home the machine
+        mb.homeAxes()
+        self.message("Tighten the levelling screws")
+        mb.goToOrigin()
+
+        currentTool = None
+        wasLastReversed = None
+        for layerId, toolpath, tool, isReversed in layers:
+            z = buildplateZ[tool]
+            if currentTool != tool or isReversed != wasLastReversed:
+                # Lower the buildplate
+                mb.moveZ(0)
+
+                # Board side
+                if isReversed != wasLastReversed:
+                    if isReversed:
+                        self.message("Board on its BACK side")
+                    else:
+                        self.message("Board on its FRONT side")
+
+                # Tool change, at the center
+                mb.move(self.reversedOriginX / 2, 10)
+                if currentTool != tool:
+                    mb.hold(['x', 'y'])
+                    self.message("Put the tool : " + str(tool))
+                    currentTool = tool
+
+                # Move to origin
+                mb.moveZ(z - self.travelHeight)
+                x = bounds[0] + offset['x']
+                if isReversed:
+                    x = self.reversedOriginX - x
+                mb.move(x, bounds[1] + offset['y'])
+
+            self.message("Start the motor, layer " + str(layerId))
+            position = dict(mb.position)
+            for i, steps, speed, duration, distance in self.compiler.moves(toolpath, offset, z, isReversed, self.reversedOriginX, position):
+                # Orders which don't move have no speed to accelerate to
+                if duration == 0:
+                    continue
+                driver.queue_extended_point(steps, speed, distance, distance / duration)
+            mb.moved(position)
+
+            # Move back to origin
+            mb.moveZ(z - self.travelHeight)
+            x = offset['x']
+            if isReversed:
+                x = self.reversedOriginX - x
+            mb.move(x, offset['y'])
+
+            wasLastReversed = isReversed
+
+        mb.release()
+        mb.moveZ(0)
+        driver.build_end_notification()
+        mb.closeFile()
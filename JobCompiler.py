@@ -0,0 +1,110 @@
+import math
+import struct
+import array
+import makerbot_driver
+import Toolpath
+
+# Payload of a QUEUE_EXTENDED_POINT command : command, 5 positions in steps, dda speed
+pointStruct = struct.Struct('<BiiiiiI')
+pointCommand = makerbot_driver.host_action_command_dict['QUEUE_EXTENDED_POINT']
+
+# Payload of a QUEUE_EXTENDED_POINT_ACCELERATED command : command, 5 positions
+# in steps, dda rate in steps per second, relative axes, distance in mm,
+# feedrate in mm/s * 64
+acceleratedStruct = struct.Struct('<BiiiiiIBfh')
+acceleratedCommand = makerbot_driver.host_action_command_dict['QUEUE_EXTENDED_POINT_ACCELERATED']
+
+
+class CompiledLayer:
+    """Contiguous buffer of ready-to-send packets generated from a layer.
+The packet i is stored in data[offsets[i]:offsets[i+1]], was generated
+from the order orders[i] of the layer and should take durations[i] seconds
+to execute."""
+    def __init__(self, layerId):
+        self.layerId = layerId
+        self.data = bytearray()
+        self.offsets = array.array('L', [0])
+        self.orders = array.array('L')
+        self.durations = array.array('d')
+        self.duration = 0
+        self.nOrders = 0
+        self.position = None
+
+    def __len__(self):
+        return len(self.orders)
+
+    def append(self, orderIndex, duration):
+        self.orders.append(orderIndex)
+        self.durations.append(duration)
+        self.duration += duration
+
+    def packet(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    __getitem__ = packet
+
+
+class JobCompiler:
+    """Converts the orders of a layer into QUEUE_EXTENDED_POINT packets in step
+space, applying the position offset, the board reversal and the buildplate
+height exactly the way Makerbot.move() and Makerbot.moveZ() would.
+When the machine is in accelerated mode, the packets are
+QUEUE_EXTENDED_POINT_ACCELERATED ones and the speeds are limited to the
+max_feedrate of the axes, a speed of 0 meaning as fast as possible."""
+    def __init__(self, mb, speeds):
+        self.mb = mb
+        self.speeds = speeds
+
+    def moves(self, toolpath, offset, buildplateZ, isReversed, reversedOriginX, position):
+        """Generate (order index, steps, speed, duration, distance) for each order
+of a layer, where distance is the length of the move in mm. position is the
+position of the head before the layer, and is updated as the moves go."""
+        # Board coordinates of every order
+        path = toolpath.copy()
+        path.offset(offset['x'], offset['y'])
+        if isReversed:
+            path.reverse(reversedOriginX)
+
+        lastSteps = self.mb.stepPosition(position)
+        up = True
+        for i, op, x, y, z in zip(xrange(len(path)), path.op, path.x, path.y, path.z):
+            if op == Toolpath.MOVE_Z:
+                if z > 0:
+                    up = True
+                    speed = self.speeds["zUp"]
+                else:
+                    up = False
+                    speed = self.speeds["zDown"]
+                z = self.mb.clampZ(buildplateZ - z)
+                distance = abs(z - position['z'])
+                position['z'] = z
+            else:
+                if up:
+                    speed = self.speeds["travel"]
+                else:
+                    speed = self.speeds["feedrate"]
+                distance = math.hypot(x - position['x'], y - position['y'])
+                position['x'] = x
+                position['y'] = y
+            steps = self.mb.stepPosition(position)
+            if self.mb.accelerated:
+                speed = self.mb.accelerate(steps, lastSteps, speed)[0]
+            duration = max(abs(steps[0] - lastSteps[0]), abs(steps[1] - lastSteps[1]), abs(steps[2] - lastSteps[2])) * speed / 1000000.
+            yield i, steps, speed, duration, distance
+            lastSteps = steps
+
+    def compileLayer(self, layerId, toolpath, offset, buildplateZ, isReversed, reversedOriginX):
+        layer = CompiledLayer(layerId)
+        layer.nOrders = len(toolpath)
+        position = dict(self.mb.position)
+        payloads = []
+        accelerated = self.mb.accelerated
+        for i, steps, speed, duration, distance in self.moves(toolpath, offset, buildplateZ, isReversed, reversedOriginX, position):
+            if accelerated and duration > 0:
+                payloads.append(acceleratedStruct.pack(acceleratedCommand, steps[0], steps[1], steps[2], steps[3], steps[4], int(1000000. / speed), 0, distance, int(distance / duration * 64)))
+            else:
+                payloads.append(pointStruct.pack(pointCommand, steps[0], steps[1], steps[2], steps[3], steps[4], int(speed)))
+            layer.append(i, duration)
+        layer.data, layer.offsets = makerbot_driver.Encoder.encode_payloads(payloads)
+        layer.position = position
+        return layer
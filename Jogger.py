@@ -0,0 +1,165 @@
+import sys
+import time
+import threading
+import Queue
+
+# A key read again within this delay, in seconds, is held down : the terminal
+# repeats it faster than it can be pressed. Once the repeats stop for as long,
+# the key is released.
+RELEASE_DELAY = 0.15
+
+# Duration of the moves queued ahead of the head while a key is held, in seconds
+LOOKAHEAD = 0.25
+
+# Duration of each of the moves queued while a key is held, in seconds
+SEGMENT = 0.05
+
+# Keys ending the jogging : Ctrl-C, Enter, Ctrl-V
+EXIT_KEYS = [3, 13, 22]
+
+# Direction of the move of each key
+DIRECTIONS = {
+    "up" : ('y', 1),
+    "down" : ('y', -1),
+    "right" : ('x', 1),
+    "left" : ('x', -1),
+    "a" : ('z', 1),
+    "q" : ('z', -1)
+}
+
+
+class KeyReader:
+    """Reads the keys in a thread and queues them, with the arrows' escape
+sequences decoded to "up", "down", "right" and "left". The thread ends after
+an exit key, queued as "exit", so that it doesn't take the keys typed next."""
+    def __init__(self, readKey):
+        self.readKey = readKey
+        self.keys = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        fifo = [0, 0, 0]
+        arrows = {65 : "up", 66 : "down", 67 : "right", 68 : "left"}
+        while True:
+            key = ord(self.readKey())
+            fifo[2] = fifo[1]
+            fifo[1] = fifo[0]
+            fifo[0] = key
+            if key in EXIT_KEYS:
+                self.keys.put("exit")
+                return
+            elif fifo[2] == 27 and fifo[1] == 91:
+                if key in arrows:
+                    self.keys.put(arrows[key])
+            elif key not in [27, 91]:
+                self.keys.put(chr(key).lower())
+
+    def get(self, timeout=None):
+        """Return the next key, or None if none came within timeout seconds"""
+        try:
+            return self.keys.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+
+class Jogger:
+    """Moves the head with the keyboard. A key pressed once moves it by the
+step size. A key held down moves it continuously : LOOKAHEAD seconds of short
+moves are kept queued ahead of the head, and the machine is stopped with
+extended_stop as soon as the key is released. Repeated keys only extend the
+jog, they don't queue moves of their own."""
+    def __init__(self, mb, readKey, speed=1000, steps=[0.1, 0.5, 1, 2, 5, 10], step=2):
+        self.mb = mb
+        self.readKey = readKey
+        self.speed = speed
+        self.steps = steps
+        self.step = step
+        self.jogging = None
+
+    def _speed(self, axis):
+        # Z moves at half speed
+        if axis == 'z':
+            return self.speed / 2
+        return self.speed
+
+    def _move(self, axis, distance):
+        # Queue a move along an axis, within the machine's envelope. Return
+        # False if the head is already at the limit.
+        mb = self.mb
+        target = max(0, min(mb.position[axis] + distance, mb.amplitude[axis]))
+        if target == mb.position[axis]:
+            return False
+        if axis == 'z':
+            mb.enqueueZ(target, self._speed(axis))
+        else:
+            position = dict(mb.position)
+            position[axis] = target
+            mb.enqueueMove(position['x'], position['y'], self._speed(axis))
+        return True
+
+    def _fill(self):
+        # Keep LOOKAHEAD seconds of moves queued ahead of the head
+        mb = self.mb
+        axis, sign = DIRECTIONS[self.jogging]
+        length = SEGMENT * 1000000. / (self._speed(axis) * mb.spm[axis])
+        now = time.time()
+        while max(mb.busyUntil, now) - now < LOOKAHEAD:
+            if not self._move(axis, sign * length):
+                break
+            # Flushing updates the estimated end of the moves
+            mb.flush()
+
+    def _stop(self):
+        self.mb.halt()
+        self.jogging = None
+
+    def _status(self):
+        position = self.mb.position
+        sys.stdout.write("\rstep : " + str(self.steps[self.step]) + "mm, X : " + str(round(position['x'], 3)) + "mm, Y : " + str(round(position['y'], 3)) + "mm, Z : " + str(round(position['z'], 3)) + "mm   ")
+        sys.stdout.flush()
+
+    def run(self):
+        """Jog until an exit key is pressed"""
+        keys = KeyReader(self.readKey)
+        lastKey = None
+        lastTime = 0
+        self._status()
+        while True:
+            timeout = None
+            if self.jogging is not None:
+                timeout = SEGMENT
+            key = keys.get(timeout)
+            now = time.time()
+
+            if key is None:
+                # Released
+                if self.jogging is not None and now - lastTime > RELEASE_DELAY:
+                    self._stop()
+            elif key == "exit":
+                if self.jogging is not None:
+                    self._stop()
+                return
+            elif key in DIRECTIONS:
+                if key == lastKey and now - lastTime <= RELEASE_DELAY:
+                    # Held down
+                    self.jogging = key
+                else:
+                    if self.jogging is not None:
+                        self._stop()
+                    axis, sign = DIRECTIONS[key]
+                    self._move(axis, sign * self.steps[self.step])
+                    self.mb.flush()
+                lastKey = key
+                lastTime = now
+            elif key == "+":
+                if self.step < len(self.steps) - 1:
+                    self.step += 1
+            elif key == "-":
+                if self.step > 0:
+                    self.step -= 1
+
+            if self.jogging is not None:
+                self._fill()
+            self._status()
@@ -1,14 +1,46 @@
+import struct
 import makerbot_driver
 import serial
 import serial.tools.list_ports
 import threading
 import sys
+import time
+import Completion
+import JobCompiler
+
+# Position of the home of the machine, in mm from the origin of the moves
+origin = {
+    'x' : -190,
+    'y' : -43,
+    'z' : 100
+}
+
+# The head can move between 0 and the amplitude on each axis
+amplitude = dict((axis, abs(value)) for axis, value in origin.items())
+
+# Payload of an ENABLE_AXES command : command, axes bitfield
+enableStruct = struct.Struct('<BB')
+enableCommand = makerbot_driver.host_action_command_dict['ENABLE_AXES']
 
 class Makerbot:
     def __init__(self):
         self.condition = threading.Condition()
         self.driver = makerbot_driver.s3g()
         self.connected = False
+        self.waiter = Completion.CompletionWaiter(self.driver.is_finished)
+        self.lastSteps = None
+        self.busyUntil = 0
+        # Send QUEUE_EXTENDED_POINT_ACCELERATED packets, planned by the firmware
+        self.accelerated = False
+        # Action payloads not sent yet, with their durations, None when unknown
+        self.queue = []
+        self.queueDurations = []
+        # Number of queued payloads which triggers a flush
+        self.queueSize = 256
+        # Packets in flight while flushing to a machine
+        self.windowSize = 4
+        # Enable state of the steppers, by axis, missing when unknown
+        self.enabled = {}
         self.profileNames = {
             "The Replicator 2" : "Replicator2"
         }
@@ -16,6 +48,7 @@ class Makerbot:
     def connect(self, port, machineName):
         self.port = serial.Serial(port, 115200, timeout=1)
         self.driver.writer = makerbot_driver.Writer.StreamWriter(self.port, self.condition)
+        self.actions = makerbot_driver.ActionQueue(self.driver)
         self.connected = True
         self.driver.init()
         self.driver.display_message(0, 0, "********************", 3, False, False, False)
@@ -23,6 +56,27 @@ class Makerbot:
         self.driver.display_message(0, 0, "    MakerBotCNC!    ", 3, True, False, False)
         self.driver.display_message(0, 0, "********************", 3, True, True, False)
         #self.driver.queue_song(6)
+        self.loadProfile(machineName)
+        self.machinePort = port
+        self.machineName = machineName
+        print("Connected to machine " + machineName + " on port " + port)
+
+    # Write the commands to a file to be played from the SD card, instead of sending them to a machine
+    def openFile(self, filename, machineName="The Replicator 2"):
+        self.driver.writer = makerbot_driver.Writer.FileWriter(open(filename, "wb"), self.condition)
+        if filename.lower().endswith(".x3g"):
+            self.driver.set_print_to_file_type('x3g')
+            self.accelerated = True
+        else:
+            self.driver.set_print_to_file_type('s3g')
+            self.accelerated = False
+        self.loadProfile(machineName)
+        self.machineName = machineName
+
+    def closeFile(self):
+        self.driver.writer.close()
+
+    def loadProfile(self, machineName):
         if machineName in self.profileNames:
             self.profile = makerbot_driver.Profile(self.profileNames[machineName])
             self.spm = {
@@ -30,28 +84,19 @@ class Makerbot:
                 'y' : self.profile.values['axes']['Y']['steps_per_mm'],
                 'z' : self.profile.values['axes']['Z']['steps_per_mm']
             }
-            self.origin = {
-                'x' : -190,
-                'y' : -43,
-                'z' : 100
-            }
+            # Fastest speed of each axis, in microseconds per step
+            self.minDDA = {}
+            for axis in ['x', 'y', 'z']:
+                self.minDDA[axis] = makerbot_driver.Gcode.compute_DDA_speed(float(self.profile.values['axes'][axis.upper()]['max_feedrate']), self.spm[axis])
+            self.origin = dict(origin)
             self.position = {
                 'x' : 0,
                 'y' : 0,
                 'z' : 0
             }
-            self.amplitude = {
-                'x' : 0,
-                'y' : 0,
-                'z' : 0
-            }
-            for axis in self.origin.keys():
-                self.amplitude[axis] = abs(self.origin[axis])
+            self.amplitude = dict(amplitude)
         else:
             raise Exception("Unknown Machine " + machineName)
-        self.machinePort = port
-        self.machineName = machineName
-        print("Connected to machine " + machineName + " on port " + port)
 
     def autoConnect(self):
         self.connected = False
@@ -70,10 +115,28 @@ class Makerbot:
                     break
 
     def home(self):
+        self.homeAxes()
+        self.barrier()
+
+        # Ask the user to tighten the screws
+        raw_input("Please tighten the levelling screws under the buildplate")
+
+        self.goToOrigin()
+        self.barrier()
+
+    # Queue the homing moves
+    def homeAxes(self):
+        # The homing commands are sent directly, after the queued ones
+        self.flush()
+
+        # The duration of the homing moves is unknown
+        self.lastSteps = None
+        self.busyUntil = 0
+        self.enabled = {}
+
         # Move Z lower
         self.driver.set_extended_position([0, 0, 0, 0, 0])
         self.driver.queue_extended_point_classic([0, 0, 5000, 0, 0], 300)
-        self.wait()
 
         # Home X/Y quickly
         self.driver.find_axes_maximums(['x', 'y'], 200, 60)
@@ -92,14 +155,11 @@ class Makerbot:
         self.driver.queue_extended_point_classic([0, 0, 1000, 0, 0], 300)
         self.driver.find_axes_minimums(['z'], 1000, 60)
         self.driver.set_extended_position([0, 0, 0, 0, 0])
-        self.wait()
-
-        # Ask the user to tighten the screws
-        raw_input("Please tighten the levelling screws under the buildplate")
 
+    # Queue the moves from the homed position to the origin
+    def goToOrigin(self):
         # Lower the buildplate a bit
-        self.driver.queue_extended_point_classic([0, 0, 20000, 0, 0], 100)
-        #self.wait()
+        self._enqueue(JobCompiler.pointStruct.pack(JobCompiler.pointCommand, 0, 0, 20000, 0, 0, 100), None)
 
         # Go to origin
         self.position = {
@@ -107,10 +167,19 @@ class Makerbot:
             'y' : 0,
             'z' : 0
         }
-        self._move(100)
-        self.wait()
+        self._enqueuePosition(100)
+        self.flush()
 
     def move(self, x, y, speed=300, relative=False):
+        self.enqueueMove(x, y, speed, relative)
+        self.flush()
+
+    def moveZ(self, z, speed=100, relative=False):
+        self.enqueueZ(z, speed, relative)
+        self.flush()
+
+    def enqueueMove(self, x, y, speed=300, relative=False):
+        """Queue a move of the head without sending it, see flush()"""
         if relative:
             self.position['x'] += x
             self.position['y'] += y
@@ -128,49 +197,209 @@ class Makerbot:
         #elif self.position['y'] > abs(self.origin['y']):
         #    self.position['y'] = abs(self.origin['y'])
 
-        # Move
-        self._move(speed)
+        self._enqueuePosition(speed)
 
-    def moveZ(self, z, speed=100, relative=False):
+    def enqueueZ(self, z, speed=100, relative=False):
+        """Queue a move of the buildplate without sending it, see flush()"""
         if relative:
             self.position['z'] += z
         else:
             self.position['z'] = z
 
         # Check for boundaries
-        if self.position['z'] < 0:
-            self.position['z'] = 0
-        if self.position['z'] > abs(self.origin['z']):
-            self.position['z'] = abs(self.origin['z'])
-
-        # Move
-        self._move(speed)
-
-    def _move(self, speed):
-        position = [(self.position['x'] + self.origin['x']) * self.spm['x'],
-                    (self.position['y'] + self.origin['y']) * self.spm['y'],
-                    (self.origin['z'] - self.position['z']) * self.spm['z'], 0, 0]
-        self.driver.queue_extended_point_classic(position, speed)
-        self.release(['z'])
-
-    def wait(self):
+        self.position['z'] = self.clampZ(self.position['z'])
+
+        self._enqueuePosition(speed)
+
+    def clampZ(self, z):
+        if z < 0:
+            return 0
+        if z > abs(self.origin['z']):
+            return abs(self.origin['z'])
+        return z
+
+    def stepPosition(self, position):
+        return [int((position['x'] + self.origin['x']) * self.spm['x']),
+                int((position['y'] + self.origin['y']) * self.spm['y']),
+                int((self.origin['z'] - position['z']) * self.spm['z']), 0, 0]
+
+    def accelerate(self, steps, lastSteps, speed):
+        """Parameters of an accelerated move from lastSteps to steps : return
+the speed, in microseconds per step of the longest axis, limited so that no
+axis goes faster than its max_feedrate, the distance in mm and the feedrate
+in mm/s. A speed of 0 moves as fast as the profile allows."""
+        master = 0
+        distance = 0
+        for i, axis in enumerate(['x', 'y', 'z']):
+            delta = abs(steps[i] - lastSteps[i])
+            master = max(master, delta)
+            distance += (delta / self.spm[axis]) ** 2
+        if master == 0:
+            return speed, 0, 0
+        for i, axis in enumerate(['x', 'y', 'z']):
+            speed = max(speed, self.minDDA[axis] * abs(steps[i] - lastSteps[i]) / master)
+        distance = distance ** 0.5
+        return speed, distance, distance * 1000000. / (master * speed)
+
+    def _enqueuePosition(self, speed):
+        # Queue the move to self.position, then release Z, which holds its
+        # position by itself
+        steps = self.stepPosition(self.position)
+        lastSteps = self.lastSteps
+        if lastSteps is None:
+            # Moves from an unknown position
+            distance = 0
+            duration = None
+        else:
+            if self.accelerated:
+                speed, distance, feedrate = self.accelerate(steps, lastSteps, speed)
+            else:
+                distance = 0
+            duration = max([abs(a - b) for a, b in zip(steps, lastSteps)]) * speed / 1000000.
+        if distance > 0:
+            payload = JobCompiler.acceleratedStruct.pack(JobCompiler.acceleratedCommand, steps[0], steps[1], steps[2], steps[3], steps[4], int(1000000. / speed), 0, distance, int(feedrate * 64))
+        else:
+            # Classic moves are not planned : the speed is the one given
+            payload = JobCompiler.pointStruct.pack(JobCompiler.pointCommand, steps[0], steps[1], steps[2], steps[3], steps[4], int(speed))
+        self._enqueue(payload, duration)
+
+        # The firmware enables the steppers of the axes which move
+        for i, axis in enumerate(['x', 'y', 'z']):
+            if lastSteps is None or steps[i] != lastSteps[i]:
+                self.enabled[axis] = True
+        self.lastSteps = steps
+        self._enqueueEnable(['z'], False)
+
+    def _enqueueEnable(self, axes, enable):
+        # Queue an ENABLE_AXES command for the axes whose state changes
+        axes = [axis for axis in axes if self.enabled.get(axis) != enable]
+        if len(axes) == 0:
+            return
+        bitfield = makerbot_driver.Encoder.encode_axes(axes)
+        if enable:
+            bitfield |= 0x80
+        self._enqueue(enableStruct.pack(enableCommand, bitfield), 0)
+        for axis in axes:
+            self.enabled[axis] = enable
+
+    def _enqueue(self, payload, duration):
+        self.queue.append(payload)
+        self.queueDurations.append(duration)
+        if len(self.queue) >= self.queueSize:
+            self.flush()
+
+    def flush(self):
+        """Send the queued commands. To a machine, they are sent windowSize at
+a time, paced on the free space of its buffer : this returns once they are
+all accepted, usually long before they are executed."""
+        if len(self.queue) == 0:
+            return
+        payloads = self.queue
+        durations = self.queueDurations
+        self.queue = []
+        self.queueDurations = []
+        start = time.time()
+        if self.connected:
+            packets = [makerbot_driver.Encoder.encode_payload(payload) for payload in payloads]
+            self._sendActions(packets, [d or 0 for d in durations], self.windowSize)
+        else:
+            for payload in payloads:
+                self.driver.writer.send_action_payload(payload)
+
+        # Estimate when the queued moves will be over
+        for duration in durations:
+            if duration is None:
+                self.busyUntil = 0
+            else:
+                self.busyUntil = max(self.busyUntil, start) + duration
+
+    def _sendActions(self, packets, durations, windowSize, callback=None):
+        # The machine keeps running the packets it accepted when a stream
+        # fails for good, possibly out of order : stop it before reporting it
         try:
-            while not self.driver.is_finished():
-                pass
+            self.actions.send_packets(packets, durations, windowSize, callback)
+        except makerbot_driver.TransmissionError:
+            self.halt()
+            raise
+
+    def barrier(self):
+        """Send the queued commands and block until the machine has executed them"""
+        self.flush()
+        try:
+            self.waiter.wait(self.estimate())
         except:
             self.stop()
             sys.exit(0)
 
+    def moved(self, position):
+        """Update the position of the head after moves sent without the queue,
+which may have moved every axis"""
+        self.position = dict(position)
+        self.lastSteps = self.stepPosition(self.position)
+        for axis in ['x', 'y', 'z']:
+            self.enabled[axis] = True
+
+    def runProgram(self, program, windowSize=1, callback=None):
+        self.flush()
+        start = time.time()
+        self._sendActions(program, program.durations, windowSize, callback)
+        if self.lastSteps is not None:
+            self.busyUntil = max(self.busyUntil, start) + program.duration
+        self.moved(program.position)
+
+    def pendingCount(self):
+        # Number of packets sent that the machine has not started yet
+        return self.actions.pending_count()
+
+    def waitAsync(self, callback=None):
+        self.flush()
+        return self.waiter.waitAsync(self.estimate(), callback)
+
+    def estimate(self):
+        if self.busyUntil == 0:
+            return None
+        return self.busyUntil
+
+    # Enabling or disabling the steppers is an action command : the machine
+    # queues it behind the moves already sent, there is no need to wait for them
     def hold(self, axes=['x','y','z']):
-        self.wait()
-        self.driver.toggle_axes(axes, True)
+        self._enqueueEnable(axes, True)
+        self.flush()
 
     def release(self, axes=['x','y','z']):
-        self.wait()
-        self.driver.toggle_axes(axes + ['a', 'b'], False)
+        self._enqueueEnable(axes + ['a', 'b'], False)
+        self.flush()
+
+    def halt(self):
+        """Stop the moves at once, dropping the queued ones, without resetting
+the machine, and read back the position where the head stopped"""
+        self.queue = []
+        self.queueDurations = []
+        self.driver.extended_stop(True, True)
+        self._resetActions()
+        steps = self.driver.get_extended_position()[0]
+        self.position = {
+            'x' : steps[0] / float(self.spm['x']) - self.origin['x'],
+            'y' : steps[1] / float(self.spm['y']) - self.origin['y'],
+            'z' : self.origin['z'] - steps[2] / float(self.spm['z'])
+        }
+        self.lastSteps = steps
+        self.busyUntil = 0
+
+    def _resetActions(self):
+        # The machine dropped the packets in its buffer
+        if self.connected:
+            self.actions.reset()
 
     def stop(self):
+        # The queued commands are dropped, and the state of the machine is unknown
+        self.queue = []
+        self.queueDurations = []
         self.driver.abort_immediately()
+        self._resetActions()
+        self.lastSteps = None
+        self.busyUntil = 0
+        self.enabled = {}
 
     def isConnected(self):
         return self.connected
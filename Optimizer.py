@@ -0,0 +1,605 @@
+import math
+import array
+import Toolpath
+
+# Maximum distance between the end of a cut and the start of the next one for
+# them to be joined without raising the tool, in mm
+JOIN_TOLERANCE = 0.01
+
+# Cut segments whose endpoints are equal once rounded to this are duplicates, in mm
+DUPLICATE_QUANTUM = 0.001
+
+# Shortest run of duplicate segments in the middle of a cut worth a retract
+# and a plunge to skip it, in mm
+MIN_SPLIT_LENGTH = 10
+
+
+class Chain:
+    """Continuous cut : the tool plunges at point 0, then moves to points 1, 2...
+without being raised. z[k] and feed[k] are the depth and gcode feedrate of
+the move to point k, or of the plunge for k = 0."""
+    def __init__(self):
+        self.x = array.array('d')
+        self.y = array.array('d')
+        self.z = array.array('d')
+        self.feed = array.array('d')
+
+    def __len__(self):
+        return len(self.x)
+
+    def add(self, x, y, z, feed):
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+        self.feed.append(feed)
+
+    def start(self):
+        return (self.x[0], self.y[0])
+
+    def end(self):
+        return (self.x[-1], self.y[-1])
+
+    def copy(self):
+        chain = Chain()
+        chain.extend(self)
+        return chain
+
+    def extend(self, chain):
+        """Continue this cut with another one, without raising the tool in between"""
+        first = 0
+        if len(self) > 0 and (chain.x[0], chain.y[0], chain.z[0]) == (self.x[-1], self.y[-1], self.z[-1]):
+            # Don't move to the point the tool is already at
+            first = 1
+        self.x.extend(chain.x[first:])
+        self.y.extend(chain.y[first:])
+        self.z.extend(chain.z[first:])
+        self.feed.extend(chain.feed[first:])
+
+    def reversed(self):
+        """Return the same cut made in the opposite direction : each segment keeps its depth and feedrate"""
+        chain = Chain()
+        chain.x = array.array('d', self.x[::-1])
+        chain.y = array.array('d', self.y[::-1])
+        chain.z = array.array('d', self.z[:1] + self.z[:0:-1])
+        chain.feed = array.array('d', self.feed[:1] + self.feed[:0:-1])
+        chain.z[0] = self.z[-1]
+        return chain
+
+    def depth(self):
+        """Deepest cut of the chain"""
+        return min(self.z)
+
+    def length(self):
+        l = 0
+        for k in range(1, len(self.x)):
+            l += math.hypot(self.x[k] - self.x[k - 1], self.y[k] - self.y[k - 1])
+        return l
+
+
+def splitChains(toolpath):
+    """Split a toolpath into its cuts, between each plunge (a Z order to a
+height <= 0) and the next retract (a Z order to a height > 0).
+Return the list of chains and the travel height, which is the height of the
+first retract, or None if the tool is never raised."""
+    chains = []
+    travelZ = None
+    chain = None
+    for op, x, y, z, feed in zip(toolpath.op, toolpath.x, toolpath.y, toolpath.z, toolpath.feed):
+        if op == Toolpath.MOVE_Z:
+            if z > 0:
+                if travelZ is None:
+                    travelZ = z
+                if chain is not None:
+                    chains.append(chain)
+                    chain = None
+            elif chain is None:
+                chain = Chain()
+                chain.add(x, y, z, feed)
+        elif chain is not None:
+            chain.add(x, y, z, feed)
+    if chain is not None:
+        chains.append(chain)
+    return chains, travelZ
+
+
+def buildToolpath(chains, travelZ):
+    """Make a toolpath cutting the chains in the given order, raising the tool
+to travelZ between them"""
+    toolpath = Toolpath.Toolpath()
+    toolpath.appendZ(travelZ)
+    for chain in chains:
+        toolpath.appendXY(chain.x[0], chain.y[0])
+        z = chain.z[0]
+        toolpath.appendZ(z, chain.feed[0])
+        for k in range(1, len(chain)):
+            if chain.z[k] != z:
+                z = chain.z[k]
+                toolpath.appendZ(z, chain.feed[k])
+            toolpath.appendXY(chain.x[k], chain.y[k], chain.feed[k])
+        toolpath.appendZ(travelZ)
+    return toolpath
+
+
+def joinChains(chains, tolerance=JOIN_TOLERANCE):
+    """Join the chains whose endpoints are within tolerance of each other into
+continuous cuts, reversing them if needed, so that the tool isn't raised and
+lowered between them. Only chains cut at the same depth are joined, so that
+a pass never follows a deeper one over the same path. Return the list of
+joined chains."""
+    # Spatial hash of the endpoints : 2c is the start of chain c, 2c + 1 its end
+    cells = {}
+    def cell(x, y):
+        return (int(math.floor(x / tolerance)), int(math.floor(y / tolerance)))
+    for c in range(len(chains)):
+        cells.setdefault(cell(*chains[c].start()), []).append(2 * c)
+        cells.setdefault(cell(*chains[c].end()), []).append(2 * c + 1)
+    used = [False] * len(chains)
+    depths = [chain.depth() for chain in chains]
+
+    def find(x, y, depth):
+        # Closest endpoint of an unused chain cut at depth within tolerance of (x, y)
+        cx, cy = cell(x, y)
+        best = None
+        bestDistance = tolerance
+        for ix in (cx - 1, cx, cx + 1):
+            for iy in (cy - 1, cy, cy + 1):
+                for p in cells.get((ix, iy), ()):
+                    if used[p // 2] or depths[p // 2] != depth:
+                        continue
+                    chain = chains[p // 2]
+                    if p % 2 == 0:
+                        d = math.hypot(chain.x[0] - x, chain.y[0] - y)
+                    else:
+                        d = math.hypot(chain.x[-1] - x, chain.y[-1] - y)
+                    if d <= bestDistance:
+                        best = p
+                        bestDistance = d
+        return best
+
+    result = []
+    for c in range(len(chains)):
+        if used[c]:
+            continue
+        used[c] = True
+        chain = chains[c].copy()
+        depth = depths[c]
+
+        # Append the chains starting (or ending) where this one ends
+        while True:
+            p = find(chain.x[-1], chain.y[-1], depth)
+            if p is None:
+                break
+            used[p // 2] = True
+            if p % 2 == 0:
+                chain.extend(chains[p // 2])
+            else:
+                chain.extend(chains[p // 2].reversed())
+
+        # Prepend the chains ending (or starting) where this one starts
+        while True:
+            p = find(chain.x[0], chain.y[0], depth)
+            if p is None:
+                break
+            used[p // 2] = True
+            if p % 2 == 1:
+                joined = chains[p // 2].copy()
+            else:
+                joined = chains[p // 2].reversed()
+            joined.extend(chain)
+            chain = joined
+        result.append(chain)
+    return result
+
+
+def _segmentKey(x0, y0, x1, y1, z, quantum):
+    # Same key for the same segment in both directions, with its endpoints
+    # rounded to the quantum
+    a = (int(round(x0 / quantum)), int(round(y0 / quantum)))
+    b = (int(round(x1 / quantum)), int(round(y1 / quantum)))
+    if b < a:
+        a, b = b, a
+    return (a, b, int(round(z / quantum)))
+
+
+def removeDuplicates(toolpath, quantum=DUPLICATE_QUANTUM, minSplit=MIN_SPLIT_LENGTH):
+    """Remove the cut segments which were already cut at the same depth,
+their endpoints being equal once rounded to quantum. Duplicates at the ends
+of a cut are dropped, but the ones in its middle only if they are at least
+minSplit long, as skipping them costs a retract and a plunge.
+Return the new toolpath and the length of cut saved."""
+    chains, travelZ = splitChains(toolpath)
+    if travelZ is None:
+        return toolpath, 0
+    seen = set()
+    result = []
+    saved = 0
+    for chain in chains:
+        n = len(chain)
+        if n < 2:
+            result.append(chain)
+            continue
+
+        # Length of each segment k - 1 -> k which was already cut, 0 otherwise
+        duplicate = [0] * n
+        for k in range(1, n):
+            key = _segmentKey(chain.x[k - 1], chain.y[k - 1], chain.x[k], chain.y[k], chain.z[k], quantum)
+            if key in seen:
+                duplicate[k] = max(math.hypot(chain.x[k] - chain.x[k - 1], chain.y[k] - chain.y[k - 1]), 1e-12)
+            else:
+                seen.add(key)
+
+        # Keep the short runs of duplicates between two new segments
+        k = 1
+        while k < n:
+            if duplicate[k] == 0:
+                k += 1
+                continue
+            end = k
+            length = 0
+            while end < n and duplicate[end] > 0:
+                length += duplicate[end]
+                end += 1
+            if k > 1 and end < n and length < minSplit:
+                for m in range(k, end):
+                    duplicate[m] = 0
+            k = end
+
+        # Split the chain around the dropped segments
+        piece = None
+        for k in range(1, n):
+            if duplicate[k] > 0:
+                saved += duplicate[k]
+                if piece is not None:
+                    result.append(piece)
+                piece = None
+                continue
+            if piece is None:
+                # Plunge at the start of the segment, to its depth
+                piece = Chain()
+                piece.add(chain.x[k - 1], chain.y[k - 1], chain.z[0] if k == 1 else chain.z[k], chain.feed[0])
+            piece.add(chain.x[k], chain.y[k], chain.z[k], chain.feed[k])
+        if piece is not None:
+            result.append(piece)
+
+    if saved == 0:
+        return toolpath, 0
+    return buildToolpath(result, travelZ), saved
+
+
+def plungeCount(toolpath):
+    """Number of times the tool is lowered into the board"""
+    count = 0
+    up = True
+    for op, z in zip(toolpath.op, toolpath.z):
+        if op == Toolpath.MOVE_Z:
+            if up and z <= 0:
+                count += 1
+            up = z > 0
+    return count
+
+
+def travelLength(toolpath, start=(0, 0)):
+    """Total length of the XY moves made with the tool up, starting from start"""
+    length = 0
+    px, py = start
+    for op, x, y, z in zip(toolpath.op, toolpath.x, toolpath.y, toolpath.z):
+        if op == Toolpath.MOVE_XY:
+            if z > 0:
+                length += math.hypot(x - px, y - py)
+            px = x
+            py = y
+    return length
+
+
+class PointGrid:
+    """Uniform grid of points for nearest neighbour queries. Points can be
+removed, so that the grid only returns the ones not visited yet."""
+    def __init__(self, xs, ys):
+        self.xs = xs
+        self.ys = ys
+        n = len(xs)
+        self.count = n
+        if n == 0:
+            self.cellSize = 1.
+            self.cells = {}
+            return
+        minX, maxX, minY, maxY = min(xs), max(xs), min(ys), max(ys)
+        area = (maxX - minX) * (maxY - minY)
+        # About 2 points per cell, or per column of cells when the points are
+        # on a line
+        self.cellSize = max(math.sqrt(2 * area / n), 2 * max(maxX - minX, maxY - minY) / n, 1e-3)
+        self.minX = minX
+        self.minY = minY
+        self.cells = {}
+        for i in range(n):
+            self.cells.setdefault(self._cell(xs[i], ys[i]), []).append(i)
+        self.maxRing = int(max(maxX - minX, maxY - minY) / self.cellSize) + 2
+        self.lastCell = self._cell(maxX, maxY)
+
+    def _cell(self, x, y):
+        return (int((x - self.minX) // self.cellSize), int((y - self.minY) // self.cellSize))
+
+    def remove(self, i):
+        cell = self.cells[self._cell(self.xs[i], self.ys[i])]
+        cell.remove(i)
+        self.count -= 1
+
+    def nearest(self, x, y, k=1):
+        """Return the indices of the k nearest points to (x, y), closest first"""
+        if self.count == 0:
+            return []
+        cx, cy = self._cell(x, y)
+        lastX, lastY = self.lastCell
+        found = []
+        # The rings closer than the grid are empty
+        ring = max(0, -cx, cx - lastX, -cy, cy - lastY)
+        while True:
+            # Cells of the grid on the border of the square of radius `ring`
+            # around the query
+            for ix in range(max(cx - ring, 0), min(cx + ring, lastX) + 1):
+                if ring == 0 or ix == cx - ring or ix == cx + ring:
+                    iys = range(max(cy - ring, 0), min(cy + ring, lastY) + 1)
+                else:
+                    iys = [iy for iy in (cy - ring, cy + ring) if 0 <= iy <= lastY]
+                for iy in iys:
+                    for i in self.cells.get((ix, iy), ()):
+                        found.append((math.hypot(self.xs[i] - x, self.ys[i] - y), i))
+            # Points further than this ring can't be closer than the ones found
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= ring * self.cellSize or len(found) >= self.count:
+                    return [i for d, i in found[:k]]
+            elif len(found) >= self.count or ring > self.maxRing + abs(cx) + abs(cy):
+                found.sort()
+                return [i for d, i in found]
+            ring += 1
+
+
+def orderChains(chains, start=(0, 0), passes=10, neighbours=8):
+    """Choose the order and direction of the chains minimizing the travel between
+them : nearest neighbour tour, improved by 2-opt moves between chains close to
+each other. Return the list of chains, reversed where needed."""
+    n = len(chains)
+    if n < 2:
+        return list(chains)
+
+    # Endpoints : 2c is the start of chain c, 2c + 1 its end
+    xs = []
+    ys = []
+    for chain in chains:
+        xs.extend([chain.x[0], chain.x[-1]])
+        ys.extend([chain.y[0], chain.y[-1]])
+
+    # Nearest neighbour tour
+    grid = PointGrid(xs, ys)
+    tour = []
+    flipped = []
+    px, py = start
+    for step in range(n):
+        p = grid.nearest(px, py)[0]
+        c = p // 2
+        grid.remove(2 * c)
+        grid.remove(2 * c + 1)
+        tour.append(c)
+        flipped.append(p % 2 == 1)
+        exit = 2 * c + (0 if p % 2 == 1 else 1)
+        px, py = xs[exit], ys[exit]
+
+    # Candidate neighbours of each chain
+    grid = PointGrid(xs, ys)
+    near = []
+    for c in range(n):
+        candidates = set()
+        for p in grid.nearest(xs[2 * c], ys[2 * c], neighbours) + grid.nearest(xs[2 * c + 1], ys[2 * c + 1], neighbours):
+            if p // 2 != c:
+                candidates.add(p // 2)
+        near.append(list(candidates))
+    startNear = list(set(p // 2 for p in grid.nearest(start[0], start[1], neighbours)))
+
+    def entry(i):
+        p = 2 * tour[i] + (1 if flipped[i] else 0)
+        return xs[p], ys[p]
+
+    def exit(i):
+        p = 2 * tour[i] + (0 if flipped[i] else 1)
+        return xs[p], ys[p]
+
+    def dist(a, b):
+        return math.hypot(a[0] - b[0], a[1] - b[1])
+
+    # 2-opt : reverse the part of the tour between positions i and j, which
+    # reverses the direction of every chain in it
+    position = [0] * n
+    for i in range(n):
+        position[tour[i]] = i
+    for p in range(passes):
+        improved = False
+        for i in range(n):
+            if i == 0:
+                before = start
+                candidates = startNear
+            else:
+                before = exit(i - 1)
+                candidates = near[tour[i - 1]]
+            for c in candidates:
+                j = position[c]
+                if j < i:
+                    continue
+                removed = dist(before, entry(i))
+                added = dist(before, exit(j))
+                if j + 1 < n:
+                    after = entry(j + 1)
+                    removed += dist(exit(j), after)
+                    added += dist(entry(i), after)
+                if added < removed - 1e-9:
+                    tour[i:j + 1] = tour[i:j + 1][::-1]
+                    flipped[i:j + 1] = [not f for f in flipped[i:j + 1][::-1]]
+                    for k in range(i, j + 1):
+                        position[tour[k]] = k
+                    improved = True
+        if not improved:
+            break
+
+    result = []
+    for c, f in zip(tour, flipped):
+        if f:
+            result.append(chains[c].reversed())
+        else:
+            result.append(chains[c])
+    return result
+
+
+def _nearestNeighbours(xs, ys, k):
+    """List, for each point, the k points closest to it"""
+    grid = PointGrid(xs, ys)
+    return [[p for p in grid.nearest(xs[i], ys[i], k + 1) if p != i][:k] for i in range(len(xs))]
+
+
+def orderPoints(xs, ys, start=(0, 0), passes=10, neighbours=8):
+    """Choose the order of visit of the points minimizing the path from start :
+nearest neighbour tour, improved by 2-opt and Or-opt moves (moving runs of 1
+to 3 consecutive points elsewhere in the tour) between points close to each
+other. Return the list of the point indices in order."""
+    n = len(xs)
+    if n < 2:
+        return range(n)
+
+    # Nearest neighbour tour
+    grid = PointGrid(xs, ys)
+    startNear = grid.nearest(start[0], start[1], neighbours)
+    tour = []
+    px, py = start
+    for step in range(n):
+        p = grid.nearest(px, py)[0]
+        grid.remove(p)
+        tour.append(p)
+        px, py = xs[p], ys[p]
+
+    near = _nearestNeighbours(xs, ys, neighbours)
+    position = [0] * n
+
+    def point(i):
+        # Point at position i of the tour, the start before the first one
+        if i < 0:
+            return start
+        return xs[tour[i]], ys[tour[i]]
+
+    def dist(a, b):
+        if a is None or b is None:
+            return 0
+        return math.hypot(a[0] - b[0], a[1] - b[1])
+
+    def place(first, last):
+        for k in range(first, last):
+            position[tour[k]] = k
+
+    place(0, n)
+    for p in range(passes):
+        improved = False
+
+        # 2-opt : reverse the part of the tour between positions i and j
+        for i in range(n):
+            before = point(i - 1)
+            # Points close to the one before i, the start for i = 0
+            candidates = near[tour[i - 1]] if i > 0 else startNear
+            for c in candidates:
+                j = position[c]
+                if j <= i:
+                    continue
+                after = point(j + 1) if j + 1 < n else None
+                if dist(before, point(j)) + dist(point(i), after) < dist(before, point(i)) + dist(point(j), after) - 1e-9:
+                    tour[i:j + 1] = tour[i:j + 1][::-1]
+                    place(i, j + 1)
+                    improved = True
+
+        # Or-opt : move the run of points i to i + length - 1 after the point at position j
+        for length in (1, 2, 3):
+            i = 0
+            while i + length <= n:
+                first = point(i)
+                last = point(i + length - 1)
+                before = point(i - 1)
+                after = point(i + length) if i + length < n else None
+                gain = dist(before, first) + dist(last, after) - dist(before, after)
+                moved = False
+                if gain > 1e-9:
+                    for c in set(near[tour[i]] + near[tour[i + length - 1]]):
+                        j = position[c]
+                        if i - 1 <= j < i + length:
+                            continue
+                        q = point(j + 1) if j + 1 < n else None
+                        forward = dist(point(j), first) + dist(last, q)
+                        backward = dist(point(j), last) + dist(first, q)
+                        cost = min(forward, backward) - dist(point(j), q)
+                        if cost < gain - 1e-9:
+                            run = tour[i:i + length]
+                            if backward < forward:
+                                run.reverse()
+                            if j < i:
+                                tour[j + 1:i + length] = run + tour[j + 1:i]
+                                place(j + 1, i + length)
+                            else:
+                                tour[i:j + 1] = tour[i + length:j + 1] + run
+                                place(i, j + 1)
+                            moved = improved = True
+                            break
+                if not moved:
+                    i += 1
+
+        if not improved:
+            break
+    return tour
+
+
+def depthGroups(chains):
+    """Split chains by depth, the shallowest first. Each group is cut before
+the next one, so that a pass is never cut before a shallower one over the
+same path, which would take the tool deeper in one pass."""
+    groups = {}
+    for chain in chains:
+        groups.setdefault(chain.depth(), []).append(chain)
+    return [groups[depth] for depth in sorted(groups, reverse=True)]
+
+
+def optimizeDrills(toolpath, start=(0, 0)):
+    """Reorder the hits of a drill layer, each an XY move followed by a plunge
+and a retract, to minimize travel. Layers with other cuts are handled by
+optimizeOrder. Return the new toolpath and the travel length before and after."""
+    chains, travelZ = splitChains(toolpath)
+    for chain in chains:
+        if len(chain) != 1:
+            return optimizeOrder(toolpath, start)
+    before = travelLength(toolpath, start)
+    if travelZ is None or len(chains) < 2:
+        return toolpath, before, before
+    ordered = []
+    position = start
+    for group in depthGroups(chains):
+        order = orderPoints([chain.x[0] for chain in group], [chain.y[0] for chain in group], position)
+        ordered.extend([group[i] for i in order])
+        position = ordered[-1].end()
+    result = buildToolpath(ordered, travelZ)
+    after = travelLength(result, start)
+    if after >= before:
+        return toolpath, before, before
+    return result, before, after
+
+
+def optimizeOrder(toolpath, start=(0, 0), joinTolerance=JOIN_TOLERANCE):
+    """Join the cuts of a toolpath which meet within joinTolerance, and reorder
+them to minimize travel, depth by depth. Return the new toolpath and the
+travel length before and after."""
+    before = travelLength(toolpath, start)
+    chains, travelZ = splitChains(toolpath)
+    if travelZ is None or len(chains) < 2:
+        return toolpath, before, before
+    ordered = []
+    position = start
+    for group in depthGroups(chains):
+        ordered.extend(orderChains(joinChains(group, joinTolerance), position))
+        position = ordered[-1].end()
+    result = buildToolpath(ordered, travelZ)
+    after = travelLength(result, start)
+    if after >= before and len(ordered) == len(chains):
+        return toolpath, before, before
+    return result, before, after
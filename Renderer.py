@@ -0,0 +1,333 @@
+import math
+import struct
+import zlib
+import collections
+import Toolpath
+import Simplifier
+
+try:
+    import pygame
+except ImportError:
+    # Only drawing needs pygame, not the tile index
+    pygame = None
+
+# Size of the tiles of the spatial index, in mm
+TILE_SIZE = 10.
+
+# Maximum number of points of the polylines stored in the index
+CHUNK_POINTS = 64
+
+# Tolerances of the simplified levels of detail, in mm. A level is used when
+# its tolerance is below half a pixel : the plot zooms from 11 to 101 pixels
+# per mm, so coarser levels would never be used.
+LOD_TOLERANCES = [0.005, 0.01, 0.02]
+
+# Number of pixels of the rendered tiles kept for panning, about 128 MB
+TILE_CACHE_PIXELS = 32 * 1000 * 1000
+
+# Number of rows of pixels rendered at once when saving an image
+BAND_HEIGHT = 256
+
+
+class TileIndex:
+    """Polylines of a layer cut into chunks of at most CHUNK_POINTS points,
+each referenced by the tiles its bounding box, widened by the tool radius,
+overlaps. chunks[i] is (cut, xs, ys, startCap, endCap), the caps telling if
+the chunk starts or ends a polyline."""
+    def __init__(self, runs, radius):
+        self.chunks = []
+        self.tiles = {}
+        for cut, xs, ys in runs:
+            n = len(xs)
+            start = 0
+            while True:
+                end = min(start + CHUNK_POINTS, n)
+                self._add((cut, xs[start:end], ys[start:end], start == 0, end == n), radius)
+                if end >= n:
+                    break
+                # Chunks share their endpoints
+                start = end - 1
+
+    def _add(self, chunk, radius):
+        i = len(self.chunks)
+        self.chunks.append(chunk)
+        cut, xs, ys, startCap, endCap = chunk
+        for tile in tilesOf(min(xs) - radius, min(ys) - radius, max(xs) + radius, max(ys) + radius):
+            self.tiles.setdefault(tile, []).append(i)
+
+
+def tilesOf(minX, minY, maxX, maxY):
+    """Tiles overlapping a rectangle, in mm"""
+    tiles = []
+    for tx in range(int(math.floor(minX / TILE_SIZE)), int(math.floor(maxX / TILE_SIZE)) + 1):
+        for ty in range(int(math.floor(minY / TILE_SIZE)), int(math.floor(maxY / TILE_SIZE)) + 1):
+            tiles.append((tx, ty))
+    return tiles
+
+
+class RenderedLayer:
+    """Toolpath of a layer split into polylines, ready to be drawn : runs of
+consecutive XY moves made with the tool down (cuts) or up (travels), each
+starting at the position before its first move, and the plunge points.
+The polylines are indexed by tile, at full detail and at the simplified
+levels of detail, which are built the first time they are used."""
+    def __init__(self, toolpath, color, toolDiameter):
+        self.color = color
+        self.toolDiameter = toolDiameter
+        self.runs = []
+        self.plunges = {}
+        xs = ys = None
+        cut = None
+        px = py = None
+        for op, x, y, z in zip(toolpath.op, toolpath.x, toolpath.y, toolpath.z):
+            if op == Toolpath.MOVE_Z:
+                if z <= 0 and px is not None:
+                    r = toolDiameter / 2.
+                    for tile in tilesOf(px - r, py - r, px + r, py + r):
+                        self.plunges.setdefault(tile, []).append((px, py))
+                continue
+            down = z <= 0
+            if down != cut or xs is None:
+                xs = []
+                ys = []
+                if px is not None:
+                    xs.append(px)
+                    ys.append(py)
+                cut = down
+                self.runs.append((cut, xs, ys))
+            xs.append(x)
+            ys.append(y)
+            px = x
+            py = y
+        self.levels = {}
+
+    def index(self, tolerance):
+        """Return the TileIndex of the level of detail with the given tolerance, 0 for full detail"""
+        if tolerance not in self.levels:
+            runs = self.runs
+            if tolerance > 0:
+                runs = []
+                for cut, xs, ys in self.runs:
+                    keep = Simplifier.simplifyPolyline(xs, ys, tolerance)
+                    runs.append((cut, [x for x, k in zip(xs, keep) if k], [y for y, k in zip(ys, keep) if k]))
+            self.levels[tolerance] = TileIndex(runs, self.toolDiameter / 2.)
+        return self.levels[tolerance]
+
+
+class Renderer:
+    """Draws layers tile by tile. Only the tiles in the view are rendered, from
+the polylines the spatial index of each layer gives for them, at the level
+of detail matching the scale. Rendered tiles are cached, so that panning the
+view mostly blits them, and rendered again when the scale changes.
+The screen position of the point (x, y) is (viewX + scale * (margin + x),
+viewY + height - scale * (margin + y))."""
+    def __init__(self, bounds, margin=5):
+        self.layers = []
+        self.margin = margin
+        self.setBounds(bounds)
+        self.scale = None
+        self.tiles = collections.OrderedDict()
+        self.cachedPixels = 0
+
+    def setBounds(self, bounds):
+        # Drawn area, in mm, including the origin
+        minX, minY, maxX, maxY = bounds
+        self.x0 = min(minX, 0) - self.margin
+        self.y0 = min(minY, 0) - self.margin
+        self.x1 = maxX + self.margin
+        self.y1 = maxY + self.margin
+
+    def addLayer(self, toolpath, color, toolDiameter):
+        """Add a layer, drawn below the ones already added"""
+        self.layers.append(RenderedLayer(toolpath, color, toolDiameter))
+        self._clearTiles()
+
+    def tolerance(self, scale):
+        # Coarsest level of detail within half a pixel
+        tolerance = 0
+        for t in LOD_TOLERANCES:
+            if t * scale <= 0.5:
+                tolerance = t
+        return tolerance
+
+    def _drawRegion(self, surface, scale, x0, y1, tiles):
+        # Draw the parts of the layers indexed in tiles on a surface whose top
+        # left corner is at (x0, y1), in mm
+        tolerance = self.tolerance(scale)
+        def screen(xs, ys):
+            return zip([int(round(scale * (x - x0))) for x in xs], [int(round(scale * (y1 - y))) for y in ys])
+
+        # Plot the layers, the first ones on top
+        for layer in self.layers[::-1]:
+            color = layer.color
+            size = int(round(scale * layer.toolDiameter))
+            index = layer.index(tolerance)
+            chunks = set()
+            plunges = set()
+            for tile in tiles:
+                chunks.update(index.tiles.get(tile, ()))
+                plunges.update(layer.plunges.get(tile, ()))
+            for i in sorted(chunks):
+                cut, xs, ys, startCap, endCap = index.chunks[i]
+                width = 2
+                if cut:
+                    width = size
+                points = screen(xs, ys)
+                if len(points) > 1:
+                    pygame.draw.lines(surface, color, False, points, max(width, 1))
+                # Round ends
+                radius = int(width / 2 - 1)
+                if radius > 0:
+                    if startCap:
+                        pygame.draw.circle(surface, color, points[0], radius)
+                    if endCap:
+                        pygame.draw.circle(surface, color, points[-1], radius)
+            radius = int(size / 2 - 1)
+            if radius > 0:
+                for x, y in plunges:
+                    pygame.draw.circle(surface, color, screen([x], [y])[0], radius)
+
+    def _drawOrigin(self, surface, ox, oy):
+        pygame.draw.line(surface, [0, 0, 0], [ox - 20, oy], [ox + 20, oy], 2)
+        pygame.draw.line(surface, [0, 0, 0], [ox, oy - 20], [ox, oy + 20], 2)
+        pygame.draw.circle(surface, [0, 0, 0], [ox + 1, oy - 1], 10, 2)
+
+    def _renderBand(self, scale, width, top, height):
+        # Draw the rows top to top + height of the whole layers at the given
+        # scale, in pixels per mm, on a new surface
+        surface = pygame.Surface((width, height))
+        surface.fill([255, 255, 255])
+        self._drawOrigin(surface, int(round(scale * -self.x0)), int(round(scale * self.y1)) - top)
+        y1 = self.y1 - top / float(scale)
+        y0 = self.y1 - (top + height) / float(scale)
+        self._drawRegion(surface, scale, self.x0, y1, tilesOf(self.x0, max(y0, self.y0), self.x1, y1))
+        return surface
+
+    def save(self, filename, scale):
+        """Render the layers and save them to a PNG file, without any window.
+The image is rendered and compressed BAND_HEIGHT rows at a time, so that it is
+never held in memory as a whole."""
+        width = max(int(math.ceil(scale * (self.x1 - self.x0))), 1)
+        height = max(int(math.ceil(scale * (self.y1 - self.y0))), 1)
+        f = open(filename, "wb")
+        try:
+            f.write("\x89PNG\r\n\x1a\n")
+            # 8 bits RGB, not interlaced
+            writePngChunk(f, "IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            compressor = zlib.compressobj()
+            rowSize = 3 * width
+            for top in range(0, height, BAND_HEIGHT):
+                band = self._renderBand(scale, width, top, min(BAND_HEIGHT, height - top))
+                pixels = pygame.image.tostring(band, "RGB")
+                # Each row starts with its filter type, none
+                rows = ["\x00" + pixels[k:k + rowSize] for k in range(0, len(pixels), rowSize)]
+                data = compressor.compress("".join(rows))
+                if data:
+                    writePngChunk(f, "IDAT", data)
+            writePngChunk(f, "IDAT", compressor.flush())
+            writePngChunk(f, "IEND", "")
+        finally:
+            f.close()
+
+    def _clearTiles(self):
+        self.tiles.clear()
+        self.cachedPixels = 0
+
+    def _tile(self, tile):
+        # Rendered tile, from the cache if possible. The tiles used the
+        # longest ago are dropped to keep the cache within TILE_CACHE_PIXELS.
+        surface = self.tiles.pop(tile, None)
+        if surface is None:
+            size = int(round(TILE_SIZE * self.scale))
+            surface = pygame.Surface((size, size))
+            surface.fill([255, 255, 255])
+            self._drawRegion(surface, self.scale, tile[0] * TILE_SIZE, (tile[1] + 1) * TILE_SIZE, [tile])
+            while self.tiles and self.cachedPixels + size * size > TILE_CACHE_PIXELS:
+                width, height = self.tiles.popitem(False)[1].get_size()
+                self.cachedPixels -= width * height
+            self.cachedPixels += size * size
+        self.tiles[tile] = surface
+        return surface
+
+    def draw(self, window, scale, viewPos, height):
+        """Draw the visible tiles to the window, rendering the ones not in the cache"""
+        if scale != self.scale:
+            self._clearTiles()
+            self.scale = scale
+        window.fill([255, 255, 255])
+
+        # Screen position of x = 0, y = 0
+        ox = viewPos[0] + scale * self.margin
+        oy = viewPos[1] + height - scale * self.margin
+
+        # Visible part of the drawn area, in mm
+        windowWidth, windowHeight = window.get_size()
+        minX = max(-ox / float(scale), self.x0)
+        maxX = min((windowWidth - ox) / float(scale), self.x1)
+        minY = max((oy - windowHeight) / float(scale), self.y0)
+        maxY = min(oy / float(scale), self.y1)
+        if minX < maxX and minY < maxY:
+            for tile in tilesOf(minX, minY, maxX, maxY):
+                left = ox + scale * tile[0] * TILE_SIZE
+                top = oy - scale * (tile[1] + 1) * TILE_SIZE
+                window.blit(self._tile(tile), (int(round(left)), int(round(top))))
+        self._drawOrigin(window, int(round(ox)), int(round(oy)))
+
+
+def writePngChunk(f, kind, data):
+    f.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+
+def writeSvg(filename, layers, bounds, margin=5, travelWidth=0.05):
+    """Write layers to an SVG file, in mm, the first ones on top.
+layers is a list of (toolpath, color, toolDiameter). The polylines are written
+while reading the toolpaths, without being stored, so that the size of the
+board doesn't matter."""
+    minX, minY, maxX, maxY = bounds
+    x0 = min(minX, 0) - margin
+    y0 = min(minY, 0) - margin
+    x1 = maxX + margin
+    y1 = maxY + margin
+    f = open(filename, "w")
+    try:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" width="%fmm" height="%fmm" viewBox="%f %f %f %f">\n' % (x1 - x0, y1 - y0, x0, -y1, x1 - x0, y1 - y0))
+        f.write('<rect x="%f" y="%f" width="%f" height="%f" fill="white"/>\n' % (x0, -y1, x1 - x0, y1 - y0))
+
+        # Flip the Y axis
+        f.write('<g transform="scale(1,-1)" fill="none" stroke-linecap="round" stroke-linejoin="round">\n')
+        for toolpath, color, toolDiameter in layers[::-1]:
+            rgb = "rgb(%i,%i,%i)" % tuple(color)
+            f.write('<g stroke="%s">\n' % rgb)
+            cut = None
+            px = py = None
+            for op, x, y, z in zip(toolpath.op, toolpath.x, toolpath.y, toolpath.z):
+                if op == Toolpath.MOVE_Z:
+                    if z <= 0 and px is not None:
+                        if cut is not None:
+                            f.write('"/>\n')
+                            cut = None
+                        f.write('<circle cx="%.4f" cy="%.4f" r="%.4f" fill="%s" stroke="none"/>\n' % (px, py, toolDiameter / 2., rgb))
+                    continue
+                down = z <= 0
+                if down != cut:
+                    # Start a new polyline at the current position
+                    if cut is not None:
+                        f.write('"/>\n')
+                    width = toolDiameter if down else travelWidth
+                    f.write('<polyline stroke-width="%.4f" points="' % width)
+                    if px is not None:
+                        f.write("%.4f,%.4f " % (px, py))
+                    cut = down
+                f.write("%.4f,%.4f " % (x, y))
+                px = x
+                py = y
+            if cut is not None:
+                f.write('"/>\n')
+            f.write('</g>\n')
+
+        # Origin
+        f.write('<g stroke="black" stroke-width="0.1"><path d="M -1 0 H 1 M 0 -1 V 1"/><circle cx="0" cy="0" r="0.5"/></g>\n')
+        f.write('</g>\n</svg>\n')
+    finally:
+        f.close()
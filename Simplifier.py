@@ -0,0 +1,111 @@
+import math
+import array
+import Toolpath
+
+# Points closer than this to the line through their neighbours are collinear, in mm
+COLLINEAR_TOLERANCE = 1e-9
+
+
+def segmentDistance(px, py, ax, ay, bx, by):
+    """Distance from (px, py) to the segment from (ax, ay) to (bx, by)"""
+    dx = bx - ax
+    dy = by - ay
+    l2 = dx * dx + dy * dy
+    if l2 == 0:
+        return math.hypot(px - ax, py - ay)
+    t = ((px - ax) * dx + (py - ay) * dy) / l2
+    t = max(0, min(1, t))
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+def simplifyPolyline(xs, ys, tolerance):
+    """Choose the points of a polyline to keep so that the removed ones are
+within tolerance of the simplified polyline : collinear points are merged,
+then the remaining ones are simplified with Ramer-Douglas-Peucker.
+The first and last points are always kept. Return a list of flags."""
+    n = len(xs)
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    if n < 3:
+        return [True] * n
+
+    # Merge collinear points
+    points = [0]
+    for k in range(1, n - 1):
+        a = points[-1]
+        if segmentDistance(xs[k], ys[k], xs[a], ys[a], xs[k + 1], ys[k + 1]) > COLLINEAR_TOLERANCE:
+            points.append(k)
+    points.append(n - 1)
+
+    # Ramer-Douglas-Peucker over the remaining points, without recursion
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        a = points[first]
+        b = points[last]
+        worst = None
+        worstDistance = tolerance
+        for k in range(first + 1, last):
+            p = points[k]
+            d = segmentDistance(xs[p], ys[p], xs[a], ys[a], xs[b], ys[b])
+            if d > worstDistance:
+                worst = k
+                worstDistance = d
+        if worst is not None:
+            keep[points[worst]] = True
+            stack.append((first, worst))
+            stack.append((worst, last))
+    return keep
+
+
+def deviation(xs, ys, keep):
+    """Largest distance between a removed point and the simplified polyline"""
+    worst = 0
+    a = 0
+    for b in range(1, len(xs)):
+        if not keep[b]:
+            continue
+        for p in range(a + 1, b):
+            worst = max(worst, segmentDistance(xs[p], ys[p], xs[a], ys[a], xs[b], ys[b]))
+        a = b
+    return worst
+
+
+def simplify(toolpath, tolerance):
+    """Remove the XY orders of the cuts which are within tolerance of the
+simplified cut. Z orders, travel moves and changes of depth or feedrate are
+kept untouched. Return the new toolpath, the number of orders removed and the
+largest deviation."""
+    n = len(toolpath)
+    keep = [True] * n
+    removed = 0
+    worst = 0
+    i = 0
+    while i < n:
+        if toolpath.op[i] != Toolpath.MOVE_XY or toolpath.z[i] > 0 or i == 0:
+            i += 1
+            continue
+
+        # Run of XY orders cut at the same depth and feedrate, starting from
+        # the position before its first order
+        end = i + 1
+        while end < n and toolpath.op[end] == Toolpath.MOVE_XY and toolpath.z[end] == toolpath.z[i] and toolpath.feed[end] == toolpath.feed[i]:
+            end += 1
+        xs = toolpath.x[i - 1:end]
+        ys = toolpath.y[i - 1:end]
+        flags = simplifyPolyline(xs, ys, tolerance)
+        for k in range(1, len(flags)):
+            if not flags[k]:
+                keep[i - 1 + k] = False
+                removed += 1
+        worst = max(worst, deviation(xs, ys, flags))
+        i = end
+
+    if removed == 0:
+        return toolpath, 0, 0
+    result = Toolpath.Toolpath()
+    for column in ["op", "x", "y", "z", "feed"]:
+        data = getattr(toolpath, column)
+        setattr(result, column, array.array(data.typecode, [v for v, k in zip(data, keep) if k]))
+    result.setBounds(None, False)
+    return result, removed, worst
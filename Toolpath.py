@@ -0,0 +1,262 @@
+import os
+import re
+import mmap
+import math
+import array
+import hashlib
+
+# Opcodes of the orders
+MOVE_Z = 0
+MOVE_XY = 1
+
+# Height of the tool before the first Z order of a layer : considered up
+START_Z = float("inf")
+
+# Maximum distance between an arc and the segments approximating it, in mm
+ARC_TOLERANCE = 0.005
+
+# G codes whose coordinates are not a move
+nonMoveCodes = (4, 10, 28, 30, 92)
+
+# Tokens of a gcode file : the words used by the moves, newlines which end
+# blocks, and the delimiters of comments, in order to skip them.
+gcodeTokens = re.compile(r"([GXYZFIJ\n;()])[ \t]*([-+]?[\d.]*)", re.IGNORECASE)
+
+
+class Toolpath:
+    """Orders of a layer, stored as columns of typed arrays.
+Order i is a MOVE_Z (move the tool to height z[i]) or a MOVE_XY (move the
+tool to x[i], y[i]). Every column is filled for every order : x and y hold
+the position of the tool after the order and z its height, so the tool is
+up during a MOVE_XY if z[i] > 0. feed is the gcode feedrate in mm/min, or 0
+if the file doesn't specify one."""
+    def __init__(self):
+        self.op = array.array('B')
+        self.x = array.array('d')
+        self.y = array.array('d')
+        self.z = array.array('d')
+        self.feed = array.array('d')
+        self._bounds = None
+        self._boundsKnown = False
+
+    def __len__(self):
+        return len(self.op)
+
+    def copy(self):
+        toolpath = Toolpath()
+        for column in ["op", "x", "y", "z", "feed"]:
+            setattr(toolpath, column, array.array(getattr(self, column).typecode, getattr(self, column)))
+        toolpath.setBounds(self._bounds, self._boundsKnown)
+        return toolpath
+
+    def digest(self):
+        """Hash of the orders, to check that a toolpath is the one a job was made from"""
+        h = hashlib.sha1()
+        for column in ["op", "x", "y", "z", "feed"]:
+            h.update(getattr(self, column).tostring())
+        return h.hexdigest()
+
+    def _last(self, column, default):
+        if len(column) == 0:
+            return default
+        return column[-1]
+
+    def appendZ(self, z, feed=0):
+        self.op.append(MOVE_Z)
+        self.x.append(self._last(self.x, 0))
+        self.y.append(self._last(self.y, 0))
+        self.z.append(z)
+        self.feed.append(feed)
+        self._boundsKnown = False
+
+    def appendXY(self, x, y, feed=0):
+        self.op.append(MOVE_XY)
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(self._last(self.z, START_Z))
+        self.feed.append(feed)
+        self._boundsKnown = False
+
+    def extend(self, toolpath, start=0, end=None):
+        """Append the orders start to end of another toolpath"""
+        if end is None:
+            end = len(toolpath)
+        for column in ["op", "x", "y", "z", "feed"]:
+            getattr(self, column).extend(getattr(toolpath, column)[start:end])
+        self._boundsKnown = False
+
+    def bounds(self):
+        """Return [minX, minY, maxX, maxY] of the XY orders, or None if there is none"""
+        if not self._boundsKnown:
+            xs = [x for op, x in zip(self.op, self.x) if op == MOVE_XY]
+            if len(xs) == 0:
+                self.setBounds(None)
+            else:
+                ys = [y for op, y in zip(self.op, self.y) if op == MOVE_XY]
+                self.setBounds([min(xs), min(ys), max(xs), max(ys)])
+        if self._bounds is None:
+            return None
+        return list(self._bounds)
+
+    def setBounds(self, bounds, known=True):
+        """Set the bounding box, when it is already known, to save bounds() a pass over the orders"""
+        self._bounds = bounds
+        self._boundsKnown = known
+
+    def transform(self, scaleX=1, scaleY=1, dx=0, dy=0):
+        """Replace x by scaleX * x + dx and y by scaleY * y + dy for every order"""
+        self.x = array.array('d', [scaleX * x + dx for x in self.x])
+        self.y = array.array('d', [scaleY * y + dy for y in self.y])
+        if self._bounds is not None:
+            xs = [scaleX * self._bounds[0] + dx, scaleX * self._bounds[2] + dx]
+            ys = [scaleY * self._bounds[1] + dy, scaleY * self._bounds[3] + dy]
+            self._bounds = [min(xs), min(ys), max(xs), max(ys)]
+
+    def offset(self, dx, dy):
+        self.transform(1, 1, dx, dy)
+
+    def reverse(self, originX):
+        """Mirror the toolpath around originX / 2, the way a board turned on its back side is"""
+        self.transform(-1, 1, originX, 0)
+
+
+def loadGcode(filename):
+    """Read the G0/G1/G2/G3 moves of a gcode file into a Toolpath.
+The file is memory-mapped and tokenized with a single regular expression
+pass, and the coordinates are appended straight to the columns. Motion
+modes are modal, so blocks with only coordinates continue the last move,
+and arcs are approximated by segments within ARC_TOLERANCE."""
+    toolpath = Toolpath()
+    f = open(filename, "rb")
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return toolpath
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+    appendOp = toolpath.op.append
+    appendX = toolpath.x.append
+    appendY = toolpath.y.append
+    appendZ = toolpath.z.append
+    appendFeed = toolpath.feed.append
+
+    # Modal state
+    motion = None
+    x = y = None
+    z = START_Z
+    feed = 0
+
+    # Words of the current block
+    bx = by = bz = bi = bj = None
+    words = skip = False
+
+    # Character ending the current comment
+    comment = None
+
+    try:
+        tokens = gcodeTokens.findall(buf)
+    finally:
+        buf.close()
+
+    # The end of the file ends the last block
+    tokens.append(("\n", ""))
+    for letter, value in tokens:
+        if letter == "\n":
+            comment = None
+            if not words:
+                continue
+        elif comment is not None:
+            if letter == comment:
+                comment = None
+            continue
+        else:
+            words = True
+            try:
+                if letter in "Xx":
+                    bx = float(value)
+                elif letter in "Yy":
+                    by = float(value)
+                elif letter in "Zz":
+                    bz = float(value)
+                elif letter in "Gg":
+                    g = int(float(value))
+                    if g in (0, 1, 2, 3):
+                        motion = g
+                    elif g in nonMoveCodes:
+                        skip = True
+                elif letter in "Ff":
+                    feed = float(value)
+                elif letter in "Ii":
+                    bi = float(value)
+                elif letter in "Jj":
+                    bj = float(value)
+                elif letter == "(":
+                    comment = ")"
+                elif letter == ";":
+                    comment = "\n"
+            except ValueError:
+                # Letter without a number, such as the axes of a G28 X Y
+                pass
+            continue
+
+        # End of a block : emit its moves
+        if motion is None or skip:
+            pass
+        elif bz is None and motion < 2 and bx is not None and by is not None:
+            # Most common block : a straight XY move
+            appendOp(MOVE_XY); appendX(bx); appendY(by); appendZ(z); appendFeed(feed)
+            x = bx
+            y = by
+        else:
+            nx = bx if bx is not None else x
+            ny = by if by is not None else y
+            moveXY = (bx is not None or by is not None) and nx is not None and ny is not None
+            # Raise the tool before moving, lower it after
+            if bz is not None and bz > z:
+                z = bz
+                appendOp(MOVE_Z); appendX(x or 0); appendY(y or 0); appendZ(z); appendFeed(feed)
+            if moveXY:
+                if motion in (2, 3) and x is not None and y is not None and (bi is not None or bj is not None):
+                    for px, py in arcPoints(x, y, nx, ny, bi or 0, bj or 0, motion == 2):
+                        appendOp(MOVE_XY); appendX(px); appendY(py); appendZ(z); appendFeed(feed)
+                else:
+                    appendOp(MOVE_XY); appendX(nx); appendY(ny); appendZ(z); appendFeed(feed)
+                x = nx
+                y = ny
+            elif bx is not None or by is not None:
+                x = nx
+                y = ny
+            if bz is not None and bz != z:
+                z = bz
+                appendOp(MOVE_Z); appendX(x or 0); appendY(y or 0); appendZ(z); appendFeed(feed)
+        bx = by = bz = bi = bj = None
+        words = skip = False
+
+    return toolpath
+
+
+def arcPoints(x0, y0, x1, y1, i, j, clockwise):
+    """Return the points approximating an arc from (x0, y0) to (x1, y1) around
+(x0 + i, y0 + j), ending with (x1, y1)"""
+    cx = x0 + i
+    cy = y0 + j
+    r = math.hypot(i, j)
+    start = math.atan2(y0 - cy, x0 - cx)
+    end = math.atan2(y1 - cy, x1 - cx)
+    sweep = end - start
+    if clockwise:
+        if sweep >= 0:
+            sweep -= 2 * math.pi
+    elif sweep <= 0:
+        sweep += 2 * math.pi
+    if r <= ARC_TOLERANCE:
+        return [(x1, y1)]
+    step = 2 * math.acos(1 - ARC_TOLERANCE / r)
+    n = max(1, int(math.ceil(abs(sweep) / step)))
+    points = []
+    for k in range(1, n):
+        a = start + sweep * k / n
+        points.append((cx + r * math.cos(a), cy + r * math.sin(a)))
+    points.append((x1, y1))
+    return points
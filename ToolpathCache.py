@@ -0,0 +1,144 @@
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+import Toolpath
+
+# File layout : header, then for each layer an entry header, the gcode file
+# name, and the op, x, y, z and feed columns of its toolpath, each padded to
+# a multiple of 8 bytes. Columns are stored in the byte order of the header.
+magic = "MBCNCTP1"
+headerStruct = struct.Struct("<8sBI")
+entryStruct = struct.Struct("<IQdI20s?dddd")
+columns = ["op", "x", "y", "z", "feed"]
+byteOrders = {"little" : 0, "big" : 1}
+
+
+def _padded(size):
+    return (size + 7) & ~7
+
+
+def fileHash(filename):
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    try:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.digest()
+
+
+class ToolpathCache:
+    """Binary sidecar file storing the parsed toolpath and bounding box of
+each layer, so that unchanged gcode files don't have to be parsed again.
+An entry is used if the size and modification time of its gcode file are
+unchanged, or if its content hash is."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            self._read()
+        except (IOError, ValueError, struct.error):
+            self.entries = {}
+
+    def _read(self):
+        if not os.path.isfile(self.filename) or os.path.getsize(self.filename) == 0:
+            return
+        f = open(self.filename, "rb")
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            m, byteOrder, count = headerStruct.unpack_from(buf, 0)
+            if m != magic:
+                raise ValueError("Not a toolpath cache")
+            swap = byteOrder != byteOrders[sys.byteorder]
+            pos = headerStruct.size
+            for i in range(count):
+                nameLength, size, mtime, n, digest, hasBounds, minX, minY, maxX, maxY = entryStruct.unpack_from(buf, pos)
+                pos += entryStruct.size
+                name = buf[pos:pos + nameLength].decode("utf-8")
+                pos += _padded(nameLength)
+                toolpath = Toolpath.Toolpath()
+                for column in columns:
+                    data = getattr(toolpath, column)
+                    length = n * data.itemsize
+                    if pos + length > len(buf):
+                        raise ValueError("Truncated toolpath cache")
+                    # Copy the column straight from the mapped file
+                    data.fromstring(buffer(buf, pos, length))
+                    if swap:
+                        data.byteswap()
+                    pos += _padded(length)
+                if hasBounds:
+                    toolpath.setBounds([minX, minY, maxX, maxY])
+                else:
+                    toolpath.setBounds(None)
+                self.entries[name] = (size, mtime, digest, toolpath)
+        finally:
+            buf.close()
+
+    def get(self, filename):
+        """Return a copy of the cached toolpath of a gcode file, or None if it
+isn't cached or the file changed"""
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        size, mtime, digest, toolpath = entry
+        st = os.stat(filename)
+        if st.st_size != size:
+            return None
+        if st.st_mtime != mtime:
+            if fileHash(filename) != digest:
+                return None
+            self.entries[filename] = (size, st.st_mtime, digest, toolpath)
+        return toolpath.copy()
+
+    def put(self, filename, toolpath):
+        st = os.stat(filename)
+        self.entries[filename] = (st.st_size, st.st_mtime, fileHash(filename), toolpath.copy())
+
+    def load(self, filename):
+        """Return the toolpath of a gcode file, from the cache if possible"""
+        toolpath = self.get(filename)
+        if toolpath is not None:
+            self.hits += 1
+            return toolpath
+        self.misses += 1
+        toolpath = Toolpath.loadGcode(filename)
+        self.put(filename, toolpath)
+        return toolpath
+
+    def save(self, filenames=None):
+        """Write the entries of the given gcode files, or all of them, to the cache file"""
+        if filenames is None:
+            filenames = self.entries.keys()
+        filenames = [name for name in filenames if name in self.entries]
+        tmp = self.filename + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            f.write(headerStruct.pack(magic, byteOrders[sys.byteorder], len(filenames)))
+            for name in filenames:
+                size, mtime, digest, toolpath = self.entries[name]
+                bounds = toolpath.bounds()
+                encodedName = name.encode("utf-8")
+                if bounds is None:
+                    f.write(entryStruct.pack(len(encodedName), size, mtime, len(toolpath), digest, False, 0, 0, 0, 0))
+                else:
+                    f.write(entryStruct.pack(len(encodedName), size, mtime, len(toolpath), digest, True, *bounds))
+                f.write(encodedName + "\0" * (_padded(len(encodedName)) - len(encodedName)))
+                for column in columns:
+                    data = getattr(toolpath, column).tostring()
+                    f.write(data + "\0" * (_padded(len(data)) - len(data)))
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
@@ -0,0 +1,74 @@
+import Toolpath
+import Makerbot
+
+
+class Violation:
+    """First order of a layer moving the head out of the machine's envelope"""
+    def __init__(self, layerId, order, axis, value, low, high):
+        self.layerId = layerId
+        self.order = order
+        self.axis = axis
+        self.value = value
+        self.low = low
+        self.high = high
+
+    def __str__(self):
+        return self.layerId + " : order " + str(self.order) + " moves " + self.axis.upper() + " to " + str(round(self.value, 3)) + "mm, out of " + str(self.low) + " to " + str(self.high) + "mm"
+
+
+def _firstOutside(values, low, high, start=0):
+    # Index of the first value from start outside [low, high]. min() and max()
+    # check the whole column at C speed, the Python scan only runs to find a
+    # violation.
+    values = values[start:]
+    if len(values) == 0 or (min(values) >= low and max(values) <= high):
+        return None
+    for i, v in enumerate(values):
+        if v < low or v > high:
+            return start + i
+    return None
+
+
+def validateLayer(layerId, toolpath, offset, isReversed, reversedOriginX, buildplateZ=None, amplitude=Makerbot.amplitude):
+    """Check that every order of a layer keeps the head within the machine's
+envelope once the offset, the board reversal and, if given, the buildplate
+height are applied, the way JobCompiler applies them. Return the first
+Violation, or None.
+Instead of transforming every coordinate, the envelope is transformed back
+to the coordinates of the toolpath."""
+    # Machine X is x + offset, or reversedOriginX - (x + offset) on the back side
+    if isReversed:
+        lowX = reversedOriginX - amplitude['x'] - offset['x']
+        highX = reversedOriginX - offset['x']
+    else:
+        lowX = -offset['x']
+        highX = amplitude['x'] - offset['x']
+    lowY = -offset['y']
+    highY = amplitude['y'] - offset['y']
+
+    # The Z orders before the first XY order hold a placeholder position, the
+    # head only moves in XY from there
+    violations = []
+    if Toolpath.MOVE_XY in toolpath.op:
+        first = toolpath.op.index(Toolpath.MOVE_XY)
+        i = _firstOutside(toolpath.x, lowX, highX, first)
+        if i is not None:
+            x = toolpath.x[i] + offset['x']
+            if isReversed:
+                x = reversedOriginX - x
+            violations.append(Violation(layerId, i, 'x', x, 0, amplitude['x']))
+        i = _firstOutside(toolpath.y, lowY, highY, first)
+        if i is not None:
+            violations.append(Violation(layerId, i, 'y', toolpath.y[i] + offset['y'], 0, amplitude['y']))
+
+    # Machine Z is buildplateZ - z. The height is unknown before the first Z
+    # order, then each order holds the height of the last one, so the first
+    # violation is a Z order.
+    if buildplateZ is not None and Toolpath.MOVE_Z in toolpath.op:
+        i = _firstOutside(toolpath.z, buildplateZ - amplitude['z'], buildplateZ, toolpath.op.index(Toolpath.MOVE_Z))
+        if i is not None:
+            violations.append(Violation(layerId, i, 'z', buildplateZ - toolpath.z[i], 0, amplitude['z']))
+
+    if len(violations) == 0:
+        return None
+    return min(violations, key=lambda v: v.order)
@@ -0,0 +1,154 @@
+""" Flow control for streams of action packets sent to a machine.
+"""
+from __future__ import absolute_import
+
+import collections
+import logging
+import time
+
+import makerbot_driver
+
+
+class ActionQueue(object):
+    """ Sends action packets to a machine while keeping its command buffer
+    close to full, but not overflowing.
+
+    The free space of the buffer is queried with get_available_buffer_size(),
+    then modeled on the host: each packet sent takes its payload length from
+    the free space, and gives it back when the machine starts executing it,
+    which is estimated from the durations of the moves queued before it.
+    Packets are only sent when the model says they fit. When they don't, the
+    queue sleeps until enough moves should have started, then queries the
+    machine again to correct the model.
+    """
+
+    def __init__(self, s3g, headroom=0, min_delay=0.01):
+        """ Initialize a new ActionQueue
+
+        @param s3g s3g object connected to the machine
+        @param int headroom Number of bytes of the buffer to keep free
+        @param float min_delay Minimum time to wait for the buffer to drain, in seconds
+        """
+        self.s3g = s3g
+        self.headroom = headroom
+        self.min_delay = min_delay
+        self.capacity = None
+        self.free = 0
+        self.total_overflows = 0
+        self.total_waits = 0
+        self._pending = collections.deque()
+        self._busy_until = 0
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def sync(self):
+        """ Query the machine for the free space in its buffer and update the model
+        """
+        reported = self.s3g.get_available_buffer_size()
+        if self.capacity is None or reported > self.capacity:
+            self.capacity = reported
+        # Forget the packets the machine has already taken out of its buffer
+        in_buffer = self.capacity - reported
+        queued = sum([size for start, size in self._pending])
+        while self._pending and queued > in_buffer:
+            queued -= self._pending.popleft()[1]
+        self.free = reported
+        self._log.debug('{"event":"buffer_sync", "free":%i, "capacity":%i}', self.free, self.capacity)
+
+    def reset(self):
+        """ Forget the model of the buffer, after the machine has dropped the packets
+        queued in it. The buffer is queried again before the next packet is sent.
+        """
+        self._pending.clear()
+        self._busy_until = 0
+        self.capacity = None
+
+    def pending_count(self):
+        """ @return Number of packets sent that the machine is estimated not to have started yet
+        """
+        self._drain(time.time())
+        return len(self._pending)
+
+    def send_packets(self, packets, durations, window_size=None, callback=None):
+        """ Send a sequence of encoded action packets, pacing them on the free space of
+        the machine's buffer. Packets rejected with a buffer overflow are sent again
+        once the buffer should have drained.
+
+        @param packets Indexable sequence of encoded action packets
+        @param durations Sequence of the estimated execution time of each packet, in seconds
+        @param int window_size Number of packets in flight, see StreamWriter.send_packets
+        @param callback Function called with the index of each acknowledged packet
+        """
+        if self.capacity is None:
+            self.sync()
+        count = len(packets)
+        progress = [0]
+        while progress[0] < count:
+            start = progress[0]
+            self._drain(time.time())
+
+            # Gather the packets that fit in the free space of the buffer
+            end = start
+            room = self.free - self.headroom
+            while end < count and self._size(packets[end]) <= room:
+                room -= self._size(packets[end])
+                end += 1
+            if end == start:
+                self._wait_for_room(self._size(packets[start]) + self.headroom)
+                continue
+
+            def on_ack(i):
+                index = start + i
+                self._queued(self._size(packets[index]), durations[index])
+                progress[0] = index + 1
+                if callback is not None:
+                    callback(index)
+
+            try:
+                self.s3g.writer.send_packets([packets[i] for i in range(start, end)], window_size, on_ack)
+            except makerbot_driver.BufferOverflowError:
+                # The model was too optimistic : wait for the next move to start
+                self.total_overflows += 1
+                delay = max(self._time_to_drain(1), self.min_delay)
+                self._log.debug('{"event":"buffer_overflow", "packet":%i, "delay":%f}', progress[0], delay)
+                time.sleep(delay)
+                self.sync()
+            except makerbot_driver.OutOfOrderError as e:
+                # Position of the failed packet in the whole sequence
+                e.index += start
+                raise
+            except makerbot_driver.PreemptedError:
+                # A stop may have cleared the buffer : query it again before
+                # sending anything else
+                self.reset()
+                raise
+
+    def _size(self, packet):
+        # The machine buffers the payload, whose length is the second byte of the packet
+        return packet[1]
+
+    def _queued(self, size, duration):
+        now = time.time()
+        start = max(self._busy_until, now)
+        self._busy_until = start + duration
+        self._pending.append((start, size))
+        self.free -= size
+
+    def _drain(self, now):
+        while self._pending and self._pending[0][0] <= now:
+            self.free += self._pending.popleft()[1]
+
+    def _time_to_drain(self, size):
+        """ @return Time until the modeled free space grows by size bytes, in seconds
+        """
+        freed = 0
+        for start, packet_size in self._pending:
+            freed += packet_size
+            if freed >= size:
+                return start - time.time()
+        return 0
+
+    def _wait_for_room(self, size):
+        self.total_waits += 1
+        delay = max(self._time_to_drain(size - self.free), self.min_delay)
+        time.sleep(delay)
+        self.sync()
@@ -1,7 +1,12 @@
 from __future__ import absolute_import
 
+import array
+
 import makerbot_driver
 
+# Header and length bytes of a packet, for each payload length
+_packet_starts = [chr(makerbot_driver.constants.header) + chr(length) for length in range(makerbot_driver.constants.maximum_payload_length + 1)]
+
 
 def encode_payload(payload):
     """
@@ -9,18 +14,54 @@ def encode_payload(payload):
     @param payload Command payload, 1 - n bytes describing the command to send
     @return bytearray containing the packet
     """
-    if len(payload) > makerbot_driver.constants.maximum_payload_length:
-        raise makerbot_driver.errors.PacketLengthError(len(payload), makerbot_driver.constants.maximum_payload_length)
-
-    packet = bytearray()
-    packet.append(makerbot_driver.constants.header)
-    packet.append(len(payload))
-    packet.extend(payload)
-    packet.append(makerbot_driver.Encoder.CalculateCRC(payload))
+    packet = bytearray(len(payload) + 3)
+    encode_payload_into(payload, packet)
 
     return packet
 
 
+def encode_payload_into(payload, buf, offset=0):
+    """
+    Encode passed payload into a packet, written into a preallocated buffer.
+    @param payload Command payload, 1 - n bytes describing the command to send
+    @param buf bytearray or writable memoryview to write the packet into. It must
+        have room for len(payload) + 3 bytes at offset.
+    @param int offset Position of the packet in buf
+    @return Position in buf right after the packet
+    """
+    length = len(payload)
+    if length > makerbot_driver.constants.maximum_payload_length:
+        raise makerbot_driver.errors.PacketLengthError(length, makerbot_driver.constants.maximum_payload_length)
+
+    end = offset + length + 2
+    buf[offset:offset + 2] = _packet_starts[length]
+    buf[offset + 2:end] = payload
+    buf[end:end + 1] = chr(makerbot_driver.Encoder.CalculateCRC(payload))
+
+    return end + 1
+
+
+def encode_payloads(payloads):
+    """
+    Encode a list of payloads into packets stored one after the other in a
+    single buffer, allocated once.
+    @param payloads list of command payloads
+    @return tuple containing the bytearray of packets, and an array of offsets
+        such that packet i is stored in buf[offsets[i]:offsets[i + 1]]
+    """
+    size = 0
+    for payload in payloads:
+        size += len(payload) + 3
+    buf = bytearray(size)
+    offsets = array.array('L', [0])
+    offset = 0
+    for payload in payloads:
+        offset = encode_payload_into(payload, buf, offset)
+        offsets.append(offset)
+
+    return buf, offsets
+
+
 def decode_packet(packet):
     """
     Decode a packet from a payload.Non-streaming packet decoder.
@@ -40,8 +81,9 @@ def decode_packet(packet):
     if packet[1] != len(packet) - 3:
         raise makerbot_driver.errors.PacketLengthFieldError(packet[1], len(packet) - 3)
 
-    if packet[len(packet) - 1] != makerbot_driver.Encoder.CalculateCRC(packet[2:(len(packet) - 1)]):
-        raise makerbot_driver.errors.PacketCRCError(packet[len(packet) - 1], makerbot_driver.Encoder.CalculateCRC(packet[2:(len(packet) - 1)]))
+    crc = makerbot_driver.Encoder.CalculateCRC(packet[2:(len(packet) - 1)])
+    if packet[len(packet) - 1] != crc:
+        raise makerbot_driver.errors.PacketCRCError(packet[len(packet) - 1], crc)
 
     return packet[2:(len(packet) - 1)]
 
@@ -83,6 +125,14 @@ def check_response_code(response_code):
     raise makerbot_driver.errors.UnknownResponseError(response_code)
 
 
+# States of the PacketStreamDecoder
+WAIT_FOR_HEADER = 0
+WAIT_FOR_LENGTH = 1
+WAIT_FOR_DATA = 2
+WAIT_FOR_CRC = 3
+PAYLOAD_READY = 4
+
+
 class PacketStreamDecoder(object):
 
     """
@@ -93,9 +143,18 @@ class PacketStreamDecoder(object):
         """
         Initialize the packet decoder
         """
-        self.state = 'WAIT_FOR_HEADER'
+        self.reset()
+
+    def reset(self):
+        """
+        Drop the packet being decoded and any leftover bytes
+        """
+        self.state = WAIT_FOR_HEADER
         self.payload = bytearray()
         self.expected_length = 0
+        self._buffer = bytearray()
+        # Payloads decoded by feed() and not returned yet
+        self.ready = []
 
     def parse_byte(self, byte):
         """
@@ -103,29 +162,88 @@ class PacketStreamDecoder(object):
         @param byte Byte to add to the stream
         """
 
-        if self.state == 'WAIT_FOR_HEADER':
+        if self.state == WAIT_FOR_HEADER:
             if byte != makerbot_driver.constants.header:
                 raise makerbot_driver.errors.PacketHeaderError(byte, makerbot_driver.constants.header)
 
-            self.state = 'WAIT_FOR_LENGTH'
+            self.state = WAIT_FOR_LENGTH
 
-        elif self.state == 'WAIT_FOR_LENGTH':
+        elif self.state == WAIT_FOR_LENGTH:
             if byte > makerbot_driver.constants.maximum_payload_length:
                 raise makerbot_driver.errors.PacketLengthFieldError(byte, makerbot_driver.constants.maximum_payload_length)
 
             self.expected_length = byte
-            self.state = 'WAIT_FOR_DATA'
+            self.state = WAIT_FOR_DATA
 
-        elif self.state == 'WAIT_FOR_DATA':
+        elif self.state == WAIT_FOR_DATA:
             self.payload.append(byte)
             if len(self.payload) == self.expected_length:
-                self.state = 'WAIT_FOR_CRC'
+                self.state = WAIT_FOR_CRC
 
-        elif self.state == 'WAIT_FOR_CRC':
-            if makerbot_driver.Encoder.CalculateCRC(self.payload) != byte:
-                raise makerbot_driver.errors.PacketCRCError(byte, makerbot_driver.Encoder.CalculateCRC(self.payload))
+        elif self.state == WAIT_FOR_CRC:
+            crc = makerbot_driver.Encoder.CalculateCRC(self.payload)
+            if crc != byte:
+                raise makerbot_driver.errors.PacketCRCError(byte, crc)
 
-            self.state = 'PAYLOAD_READY'
+            self.state = PAYLOAD_READY
 
         else:
             raise Exception('Parser in bad state: too much data provided?')
+
+    def feed(self, data):
+        """
+        Add a chunk of bytes from the stream, of any length.
+        Bytes following the last complete packet are kept for the next call.
+        If a packet is invalid, its bytes are dropped so that decoding can resume
+        with the next call, and the error is raised. The payloads decoded before
+        it are kept in self.ready, and returned first by the next call.
+        @param data str or bytearray of bytes read from the stream
+        @return list of the payloads of every packet completed since the last return
+        """
+        buf = self._buffer
+        buf.extend(data)
+        size = len(buf)
+        pos = 0
+        payloads = self.ready
+        header = makerbot_driver.constants.header
+        try:
+            while pos < size:
+                state = self.state
+                if state == WAIT_FOR_DATA:
+                    count = min(self.expected_length - len(self.payload), size - pos)
+                    self.payload += buf[pos:pos + count]
+                    pos += count
+                    if len(self.payload) == self.expected_length:
+                        self.state = WAIT_FOR_CRC
+                    continue
+
+                byte = buf[pos]
+                pos += 1
+                if state == WAIT_FOR_HEADER:
+                    if byte != header:
+                        raise makerbot_driver.errors.PacketHeaderError(byte, header)
+                    self.state = WAIT_FOR_LENGTH
+
+                elif state == WAIT_FOR_LENGTH:
+                    if byte > makerbot_driver.constants.maximum_payload_length:
+                        self.state = WAIT_FOR_HEADER
+                        raise makerbot_driver.errors.PacketLengthFieldError(byte, makerbot_driver.constants.maximum_payload_length)
+                    self.expected_length = byte
+                    self.state = WAIT_FOR_DATA if byte > 0 else WAIT_FOR_CRC
+
+                elif state == WAIT_FOR_CRC:
+                    payload = self.payload
+                    self.payload = bytearray()
+                    self.state = WAIT_FOR_HEADER
+                    crc = makerbot_driver.Encoder.CalculateCRC(payload)
+                    if crc != byte:
+                        raise makerbot_driver.errors.PacketCRCError(byte, crc)
+                    payloads.append(payload)
+
+                else:
+                    raise Exception('Parser in bad state: too much data provided?')
+        finally:
+            del buf[:pos]
+
+        self.ready = []
+        return payloads
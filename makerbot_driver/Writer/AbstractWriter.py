@@ -31,6 +31,16 @@ class AbstractWriter(object):
         """
         raise NotImplementedError()
 
+    def send_priority_payload(self, payload):
+        """ Send the given payload ahead of the packets being sent by other
+        threads, such as an abort. Writers which can't preempt their traffic
+        send it as a query command.
+
+        @param bytearray payload Payload to send
+        @return The response payload
+        """
+        return self.send_query_payload(payload)
+
     def set_external_stop(self, value=True):
         with self._condition:
             self.external_stop = value
@@ -3,7 +3,10 @@
 from __future__ import absolute_import
 
 import time
+import struct
 import logging
+import threading
+import collections
 
 from . import AbstractWriter
 import makerbot_driver
@@ -25,6 +28,26 @@ class StreamWriter(AbstractWriter):
                        str(self.file))
         self.total_retries = 0
         self.total_overflows = 0
+        self.window_size = 1
+        self.overflow_delay = 0.05
+        self._decoder = makerbot_driver.Encoder.PacketStreamDecoder()
+        # Responses decoded and not read yet, and the errors of invalid packets
+        # between them
+        self._responses = collections.deque()
+        # Writes are serialized by their own lock, held for one packet at a
+        # time, so that a priority packet never waits for a response
+        self._write_lock = threading.Lock()
+        self._priority = collections.deque()
+        self._stream_thread = None
+        # Packets written and responses read, other than the priority ones,
+        # so that each priority response is read after those of the packets
+        # written before it
+        self._stream_written = 0
+        self._stream_read = 0
+        # Set when the streaming thread sent a priority packet itself
+        self._preempted = False
+        self.last_priority_latency = None
+        self.max_priority_latency = 0
 
     # TODO: test me
     def send_query_payload(self, payload):
@@ -56,6 +79,109 @@ class StreamWriter(AbstractWriter):
         packet = makerbot_driver.Encoder.encode_payload(payload)
         return self.send_packet(packet)
 
+    def send_priority_payload(self, payload):
+        """
+        Send a payload ahead of the packets being streamed by another thread,
+        without waiting for their responses. The packet is written as soon as
+        the packet being written, if any, is, and the stream writes no packet
+        after it. The streaming thread then reads the responses of the packets
+        written before it, hands over the response of this one and raises a
+        PreemptedError, as its remaining packets must not follow a stop. When
+        called by the streaming thread itself, from a callback, the responses
+        are read at once, and the stream raises the PreemptedError once the
+        callback returns. The time taken to put the packet on the wire is kept
+        in last_priority_latency and max_priority_latency.
+        @param payload Payload to send
+        @return Response payload
+        """
+        packet = makerbot_driver.Encoder.encode_payload(payload)
+        slot = {"done" : threading.Event(), "response" : None, "error" : None}
+        start = time.time()
+        with self._write_lock:
+            self.file.write(packet)
+            self.file.flush()
+            slot["before"] = self._stream_written
+            self._priority.append(slot)
+        latency = time.time() - start
+        self.last_priority_latency = latency
+        self.max_priority_latency = max(self.max_priority_latency, latency)
+        self._log.info('{"event":"priority_packet", "latency":%f, "max_latency":%f}', latency, self.max_priority_latency)
+
+        if self._stream_thread is threading.current_thread():
+            # The condition is already held by this thread
+            self._serve_priority()
+            self._preempted = True
+
+        # Read the response unless a stream does it
+        while not slot["done"].is_set():
+            if self._condition.acquire(False):
+                try:
+                    self._serve_priority()
+                finally:
+                    self._condition.release()
+            else:
+                slot["done"].wait(0.001)
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["response"]
+
+    def _serve_priority(self):
+        """
+        Read the responses of the priority packets sent, after those of the
+        other packets written before each of them, and hand them to their
+        senders. Must be called with the condition acquired.
+        """
+        while self._priority:
+            slot = self._priority[0]
+            while self._stream_read < slot["before"]:
+                try:
+                    self._read_stream_response()
+                except makerbot_driver.TimeoutError:
+                    self._stream_read = slot["before"]
+                except makerbot_driver.PacketDecodeError:
+                    pass
+            try:
+                slot["response"] = self._read_response()
+                makerbot_driver.Encoder.check_response_code(slot["response"][0])
+            except Exception as e:
+                slot["error"] = e
+            self._priority.popleft()
+            slot["done"].set()
+
+    def _check_priority(self):
+        """
+        If priority packets were sent while streaming, serve them and raise a
+        PreemptedError. Must be called with the condition acquired.
+        """
+        if not self._priority and not self._preempted:
+            return
+        self._log.debug('{"event":"preempted", "in_flight":%i}', self._stream_written - self._stream_read)
+        self._serve_priority()
+        self._preempted = False
+        raise makerbot_driver.PreemptedError
+
+    def _write_stream_packet(self, packet):
+        """
+        Write a packet unless a priority packet is waiting for its response,
+        which no packet may follow.
+        @return False if the packet was not written
+        """
+        with self._write_lock:
+            if self._priority:
+                return False
+            self.file.write(packet)
+            self._stream_written += 1
+            return True
+
+    def _read_stream_response(self):
+        """
+        Read the response of a packet written by _write_stream_packet.
+        Must be called with the condition acquired.
+        @return Response payload
+        """
+        self._stream_read += 1
+        return self._read_response()
+
     def send_packet(self, packet):
         """
         Attempt to send a packet to the machine, retrying up to 5 times if an error
@@ -70,38 +196,37 @@ class StreamWriter(AbstractWriter):
             if self.external_stop:
                 self._log.error('{"event":"external_stop"}')
                 raise makerbot_driver.ExternalStopError
-            decoder = makerbot_driver.Encoder.PacketStreamDecoder()
-            with self._condition:
-                self.file.write(packet)
-                self.file.flush()
-
-            # Timeout if a response is not received within 1 second.
-            start_time = time.time()
-
             try:
+                # Keep the condition between the packet and its response, so that
+                # another thread can't send a packet and read this response instead
                 with self._condition:
-                    while (decoder.state != 'PAYLOAD_READY'):
-                        # Try to read a byte
-                        data = ''
-                        while data == '':
-                            if (time.time() > start_time + makerbot_driver.timeout_length):
-                                self._log.error('{"event":"machine_timeout"}')
-                                raise makerbot_driver.TimeoutError(len(data), decoder.state)
-
-                            # pySerial streams handle blocking read. Be sure to set up a timeout when
-                            # initializing them, or this could hang forever
-                            data = self.file.read(1)
-
-                        data = ord(data)
-                        decoder.parse_byte(data)
-
-                    makerbot_driver.Encoder.check_response_code(decoder.payload[0])
+                    # Sent by a callback of a stream, which is preempted
+                    # once the callback returns rather than this packet
+                    stream_thread = self._stream_thread
+                    nested = stream_thread is not None
+                    self._stream_thread = threading.current_thread()
+                    try:
+                        if not nested:
+                            self._check_priority()
+                        while not self._write_stream_packet(packet):
+                            if not nested:
+                                self._check_priority()
+                            self._serve_priority()
+                            self._preempted = True
+                        with self._write_lock:
+                            self.file.flush()
+                        payload = self._read_stream_response()
+                        makerbot_driver.Encoder.check_response_code(payload[0])
+                        if not nested:
+                            self._check_priority()
+                    finally:
+                        self._stream_thread = stream_thread
                     if self.external_stop:
                         self._log.error('{"event":"external_stop"}')
                         raise makerbot_driver.ExternalStopError
 
                 # TODO: Should we chop the response code?
-                return decoder.payload
+                return payload
 
             except (makerbot_driver.BufferOverflowError) as e:
                 # Relative to the StreamWriter, BufferOverflowErrors aren't retryable.  But, they
@@ -122,6 +247,10 @@ class StreamWriter(AbstractWriter):
                 self.total_retries += 1
                 retry_count += 1
                 received_errors.append(e.__class__.__name__)
+                self._reset_responses()
+
+            except makerbot_driver.PreemptedError:
+                raise
 
             except Exception as e:
                 # Other exceptions are propigated upwards.
@@ -132,3 +261,205 @@ class StreamWriter(AbstractWriter):
             if retry_count >= makerbot_driver.max_retry_count:
                 self._log.error('{"event":"transmission_error"}')
                 raise makerbot_driver.TransmissionError(received_errors)
+
+    def send_packets(self, packets, window_size=None, callback=None):
+        """
+        Send a sequence of action packets, keeping up to window_size packets in
+        flight instead of waiting for each response before sending the next packet.
+        Responses are matched to packets in order. When a packet fails, no other
+        packet is sent: the responses of the packets in flight are read, and the
+        stream is resynchronized with a query. If the machine accepted none of
+        the packets sent after the failed one, a retryable error is retried from
+        the failed packet, and a buffer overflow is raised for the caller to wait
+        for the buffer to drain. Otherwise the packets would run out of order,
+        and an OutOfOrderError is raised for the caller to stop the machine.
+        @param packets Indexable sequence of encoded action packets
+        @param int window_size Number of packets in flight, defaults to self.window_size
+        @param callback Function called with the index of each acknowledged packet
+        """
+        if window_size is None:
+            window_size = self.window_size
+        if window_size <= 1:
+            for i in range(len(packets)):
+                self.send_packet(packets[i])
+                if callback is not None:
+                    callback(i)
+            return
+
+        count = len(packets)
+        next_send = 0
+        next_ack = 0
+        retry_count = 0
+        received_errors = []
+        with self._condition:
+            stream_thread = self._stream_thread
+            self._stream_thread = threading.current_thread()
+            try:
+                while next_ack < count:
+                    if self.external_stop:
+                        self._log.error('{"event":"external_stop"}')
+                        raise makerbot_driver.ExternalStopError
+                    self._check_priority()
+
+                    # Fill the window, one packet at a time so that a priority
+                    # packet can be written in between, and stop at once after it
+                    while next_send < count and next_send - next_ack < window_size:
+                        if not self._write_stream_packet(packets[next_send]):
+                            self._check_priority()
+                        next_send += 1
+                    with self._write_lock:
+                        self.file.flush()
+
+                    # Wait for the response of the oldest packet in flight
+                    try:
+                        payload = self._read_stream_response()
+                        makerbot_driver.Encoder.check_response_code(payload[0])
+                        if callback is not None:
+                            callback(next_ack)
+                        next_ack += 1
+                        retry_count = 0
+                        continue
+
+                    except makerbot_driver.BufferOverflowError as e:
+                        self._log.debug('{"event":"buffer_overflow", "packet":%i, "in_flight":%i}', next_ack, next_send - next_ack)
+                        self.total_overflows += 1
+                        error = e
+
+                    except makerbot_driver.RetryableError as e:
+                        self._log.debug('{"event":"transmission_problem", "exception":"%s", "message":"%s", "packet":%i, "retry_count"=%i}', type(e), e.__str__(), next_ack, retry_count)
+                        self.total_retries += 1
+                        retry_count += 1
+                        received_errors.append(e.__class__.__name__)
+                        error = e
+
+                    # Stop the window, and find out whether the machine took
+                    # packets sent after the failed one
+                    self._check_priority()
+                    accepted = self._drain_responses(next_send - next_ack - 1)
+                    self._resync()
+                    if accepted:
+                        self._log.error('{"event":"out_of_order", "packet":%i}', next_ack)
+                        raise makerbot_driver.OutOfOrderError(received_errors + [error.__class__.__name__], next_ack)
+                    if isinstance(error, makerbot_driver.BufferOverflowError):
+                        raise error
+                    if retry_count >= makerbot_driver.max_retry_count:
+                        self._log.error('{"event":"transmission_error"}')
+                        raise makerbot_driver.TransmissionError(received_errors)
+
+                    # Go back to the failed packet
+                    next_send = next_ack
+
+                # A priority packet sent by the callback of the last packet
+                self._check_priority()
+            finally:
+                self._stream_thread = stream_thread
+
+    def _read_response(self):
+        """
+        Return the next response payload, reading from the stream if none has
+        been decoded yet. Every byte waiting in the stream is read at once, and
+        the decoder keeps the bytes of incomplete packets for the next read.
+        The error of an invalid packet is raised in turn, after the responses
+        decoded before it.
+        Must be called with the condition acquired.
+        @return Response payload
+        """
+        # Timeout if a response is not received within 1 second.
+        start_time = time.time()
+
+        while not self._responses:
+            if (time.time() > start_time + makerbot_driver.timeout_length):
+                self._log.error('{"event":"machine_timeout"}')
+                raise makerbot_driver.TimeoutError(len(self._decoder.payload), self._decoder.state)
+
+            # pySerial streams handle blocking read. Be sure to set up a timeout when
+            # initializing them, or this could hang forever
+            data = self.file.read(max(self.file.inWaiting(), 1))
+            if data:
+                self._decode(data)
+
+        response = self._responses.popleft()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def _decode(self, data):
+        """
+        Queue the responses decoded from a chunk of the stream. Each run of
+        invalid bytes is queued as a single error, and decoding resumes after it.
+        @param data Bytes read from the stream
+        """
+        while True:
+            try:
+                self._responses.extend(self._decoder.feed(data))
+                return
+            except makerbot_driver.PacketDecodeError as e:
+                ready = self._decoder.ready
+                self._decoder.ready = []
+                if ready or not self._responses or not isinstance(self._responses[-1], Exception):
+                    self._responses.extend(ready)
+                    self._responses.append(e)
+                data = ''
+
+    def _reset_responses(self):
+        """
+        Forget the responses already decoded and the bytes of incomplete ones.
+        """
+        self._decoder.reset()
+        self._responses.clear()
+        self._stream_read = self._stream_written
+
+    def _drain_responses(self, count):
+        """
+        Read the responses of packets still in flight after an error, then drop
+        whatever is left in the input buffer.
+        Must be called with the condition acquired.
+        @param int count Number of responses still expected
+        @return True if the machine accepted one of these packets
+        """
+        accepted = False
+        for i in range(count):
+            try:
+                payload = self._read_stream_response()
+                makerbot_driver.Encoder.check_response_code(payload[0])
+                accepted = True
+            except makerbot_driver.TimeoutError:
+                break
+            except Exception:
+                pass
+        self.file.flushInput()
+        self._reset_responses()
+        return accepted
+
+    def _resync(self):
+        """
+        Query the free space of the machine's buffer, dropping the responses
+        read before the one of the query, so that the next response read
+        matches the next packet sent.
+        Must be called with the condition acquired.
+        @return Free space of the buffer, in bytes
+        """
+        payload = struct.pack('<B', makerbot_driver.host_query_command_dict['GET_AVAILABLE_BUFFER_SIZE'])
+        packet = makerbot_driver.Encoder.encode_payload(payload)
+        received_errors = []
+        for attempt in range(makerbot_driver.max_retry_count):
+            if not self._write_stream_packet(packet):
+                self._check_priority()
+            with self._write_lock:
+                self.file.flush()
+            try:
+                # Late responses of action packets only hold a response code.
+                # They were already counted as read, and so is the query once
+                # its response comes.
+                while True:
+                    response = self._read_response()
+                    if len(response) == 5:
+                        self._stream_read = self._stream_written
+                        makerbot_driver.Encoder.check_response_code(response[0])
+                        return struct.unpack('<I', str(response[1:]))[0]
+            except makerbot_driver.RetryableError as e:
+                received_errors.append(e.__class__.__name__)
+                self.file.flushInput()
+                self._reset_responses()
+        self._log.error('{"event":"transmission_error"}')
+        raise makerbot_driver.TransmissionError(received_errors)
@@ -1,4 +1,4 @@
-__all__ = ['GcodeProcessors', 'Encoder', 'EEPROM', 'FileReader', 'Gcode', 'Writer', 'MachineFactory', 'MachineDetector', 's3g', 'profile', 'constants', 'errors', 'GcodeAssembler', 'Factory']
+__all__ = ['GcodeProcessors', 'Encoder', 'EEPROM', 'FileReader', 'Gcode', 'Writer', 'MachineFactory', 'MachineDetector', 's3g', 'profile', 'constants', 'errors', 'GcodeAssembler', 'Factory', 'ActionQueue']
 
 __version__ = '0.1.1'
 
@@ -10,6 +10,7 @@ from GcodeAssembler import *
 from MachineDetector import *
 from MachineFactory import *
 from Factory import *
+from ActionQueue import *
 import GcodeProcessors
 import Encoder
 import EEPROM
@@ -120,6 +120,19 @@ class TransmissionError(IOError):
                                   #a list of proximate errors that caused this
 
 
+class OutOfOrderError(TransmissionError):
+    """
+    An out of order error is raised when a packet failed after the machine
+    accepted packets sent after it in the same window, so that sending it again
+    would run it out of order. The machine should be stopped, and the sequence
+    resumed from a known position. index is the position of the failed packet
+    in the sequence sent.
+    """
+    def __init__(self, value, index):
+        TransmissionError.__init__(self, value)
+        self.index = index
+
+
 class ToolBusError(IOError):
     """
     A toolbus error signifies a transmission error between the machine and its
@@ -243,3 +256,10 @@ class ExternalStopError(Exception):
     source wishes to force the StreamWriter to stop
     sending packets to a stream.
     """
+
+
+class PreemptedError(ExternalStopError):
+    """
+    A PreemptedError is thrown by a stream of packets interrupted
+    by a priority command, such as an abort, sent from another thread.
+    """
@@ -377,7 +377,7 @@ class s3g(object):
             bitfield,
         )
 
-        response = self.writer.send_query_payload(payload)
+        response = self.writer.send_priority_payload(payload)
 
         [response_code, extended_stop_response] = makerbot_driver.Encoder.unpack_response('<BB', response)
         # TODO: check response_code
@@ -690,7 +690,7 @@ class s3g(object):
             makerbot_driver.host_query_command_dict['ABORT_IMMEDIATELY']
         )
 
-        resposne = self.writer.send_query_payload(payload)
+        resposne = self.writer.send_priority_payload(payload)
 
     def playback_capture(self, filename):
         """
@@ -843,10 +843,10 @@ class s3g(object):
 
         payload = struct.pack(
             '<BiiiiiIBfh',
-        makerbot_driver.makerbot_driver.host_action_command_dict[
+        makerbot_driver.host_action_command_dict[
             'QUEUE_EXTENDED_POINT_ACCELERATED'],
         position[0], position[1], position[2], position[3], position[4],
-        dda_rate,
+        int(dda_rate),
         makerbot_driver.Encoder.encode_axes(relative_axes),
         float(distance),
         int(feedrate * 64.0)
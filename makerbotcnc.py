@@ -2,7 +2,8 @@
 
 import os, sys, readline, json, re, math
 import pygame
-import Makerbot, getch
+import makerbot_driver
+import Makerbot, Checkpoint, JobCompiler, Estimator, Exporter, Optimizer, Renderer, Simplifier, Toolpath, ToolpathCache, Validator, Jogger, getch
 
 # Project infos
 project = {
@@ -20,8 +21,15 @@ commands = [
     "layer",
     "load",
     "plot",
+    "optimize",
+    "simplify",
+    "dedup",
+    "estimate",
+    "motion",
     "connect",
     "run",
+    "resume",
+    "export",
     "home",
     "move",
     "release",
@@ -36,9 +44,16 @@ commandsHelp = {
     "layers": ["", "Show the layers list"],
     "layer": ["", "Modify a layer"],
     "load": ["", "Load the gcode files"],
-    "plot": ["", "Display the current layers"],
+    "plot": ["[--out FILE] [LAYER ...]", "Display the current layers, or save them to a .png or .svg FILE"],
+    "optimize": ["[LAYER ...]", "Join and reorder the cuts of the loaded layers to minimize travel"],
+    "simplify": ["[TOLERANCE] [LAYER ...]", "Remove the points of the cuts within TOLERANCE mm of a straight line"],
+    "dedup": ["[LAYER ...]", "Remove the segments cut more than once in the loaded layers"],
+    "estimate": ["[LAYER ...]", "Show the statistics and estimated time of the layers"],
+    "motion": ["[classic|accelerated]", "Show or set how the moves are sent, accelerated ones being planned by the firmware"],
     "connect": ["", "Connect to the machine"],
     "run": ["", "Start manufacturing the board"],
+    "resume": ["", "Resume an interrupted run from its last completed order"],
+    "export": ["FILE [LAYER ...]", "Write the job to a .s3g or .x3g file to be played from the SD card"],
     "home": ["", "Put the toolhead at its home position"],
     "move": ["X Y", "Move the head to the given position"],
     "release": ["", "Release the steppers, allowing the toolhead to be moved freely"],
@@ -61,9 +76,39 @@ standardLayersColors = {
     "Drill.1mm" : [0, 100, 200]
 }
 
-# Machine orders generated from gcode
+# Machine orders generated from gcode, as a Toolpath for each layer
 orders = {}
 
+# Speeds used to make a layer, in microseconds per step
+runSpeeds = {
+    "feedrate" : 3000,
+    "travel" : 500,
+    "zUp" : 400,
+    "zDown" : 3000
+}
+
+# Speeds used to make a layer in accelerated mode, in microseconds per step.
+# The firmware ramps the speed up and down, and the speeds are limited to the
+# max_feedrate of the machine profile, 0 meaning as fast as it allows.
+acceleratedSpeeds = {
+    "feedrate" : 2000,
+    "travel" : 0,
+    "zUp" : 0,
+    "zDown" : 3000
+}
+
+# Default tolerance of the simplification of the cuts, in mm
+simplifyTolerance = 0.005
+
+# Height of the tool above the board while travelling, in mm
+travelHeight = 3
+
+# X coordinate of the mirror of the layers made on the back side of the board
+reversedOriginX = 71
+
+# Number of packets sent ahead of the machine's responses while making a layer
+pipelineDepth = 4
+
 # Tools
 standardTools = [
     {"diameter" : 0.2, "description" : "0.2mm engraving bit"},
@@ -108,8 +153,8 @@ def ask(prompt="", choices=None, default=None, type=str):
             if default != None:
                 return default
         else:
-            if type == int:
-                answer = int(answer)
+            if type in (int, float):
+                answer = type(answer)
             if choices == None or answer in choices:
                 return answer
 
@@ -119,34 +164,52 @@ def waitKey():
         cmd_exit()
 
 
-## Load a gcode file
-def loadGcode(filename):
-    f = file(filename, "r")
-    p = re.compile(ur"(G|M|F)(\d+(?:\.\d*)?) *(X\-?\d*\.?\d*)? *(Y\-?\d*\.?\d*)? *(Z\-?\d*\.?\d*)? *(P\-?\d*\.?\d*)?", re.IGNORECASE)
-    result = []
-    for line in f:
-        m = p.match(line)
-        if m:
-            g = m.groups()
-            c = g[0].upper()
-            n = x = y = z = None
-            try:
-                n = int(g[1])
-            except ValueError:
-                n = float(g[1])
-            if g[2] != None and g[2][0].upper() == "X":
-                x = float(g[2][1:])
-            if g[3] != None and g[3][0].upper() == "Y":
-                y = float(g[3][1:])
-            if g[4] != None and g[4][0].upper() == "Z":
-                z = float(g[4][1:])
-            if c == "G":
-                if n in [0, 1]:
-                    if z:
-                        result.append([z])
-                    elif x and y:
-                        result.append([x, y])
-    return result
+## Compute the bounding box [minX, minY, maxX, maxY] of some loaded layers
+def layersBounds(layerIds):
+    bounds = None
+    for layerId in layerIds:
+        b = orders[layerId].bounds()
+        if b is None:
+            continue
+        if bounds is None:
+            bounds = b
+        else:
+            bounds = [min(bounds[0], b[0]), min(bounds[1], b[1]), max(bounds[2], b[2]), max(bounds[3], b[3])]
+    if bounds is None:
+        bounds = [0, 0, 0, 0]
+    return bounds
+
+
+## Format a duration in seconds as hours, minutes and seconds
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    return str(seconds / 3600) + "h" + str(seconds / 60 % 60).zfill(2) + "m" + str(seconds % 60).zfill(2) + "s"
+
+
+## Check that some layers keep the head within the machine's envelope, with
+## the buildplate heights by tool if known, and ask whether to go on otherwise
+def checkEnvelope(layerIds, offset, buildplateZ=None):
+    ok = True
+    for layerId in layerIds:
+        layer = project["layers"][layerId]
+        z = None
+        if buildplateZ is not None:
+            z = buildplateZ.get(layer["tool"]["description"])
+        violation = Validator.validateLayer(layerId, orders[layerId], offset, layer["reversed"], reversedOriginX, z)
+        if violation is not None:
+            print("Out of the machine's envelope : " + str(violation))
+            ok = False
+    if ok:
+        return True
+    return ask("Continue anyway? [y/N] ", choices=["y", "n"], default="n") == "y"
+
+
+## Apply the motion mode of the project to the machine and return the speeds to use with it
+def motionSpeeds():
+    mb.accelerated = project.get("motion", "classic") == "accelerated"
+    if mb.accelerated:
+        return acceleratedSpeeds
+    return runSpeeds
 
 
 ## Tries to load a currently existing project in the working directory
@@ -344,7 +407,7 @@ def cmd_home(args):
         return
     print("Moving...")
     mb.home()
-    mb.wait()
+    mb.barrier()
 
 def cmd_release(args):
     if not mb.isConnected():
@@ -362,30 +425,18 @@ def cmd_load(args=None):
     if args is not None or orders == {}:
         print("Loading Gcode files...")
 
-        # Load gcodes
+        # Load gcodes, only parsing the files which changed since the last time
         orders = {}
+        cache = ToolpathCache.ToolpathCache(project["name"] + ".mbcnc.cache")
+        files = []
         for layerId in project["layersOrder"]:
-            orders[layerId] = loadGcode(project["layers"][layerId]["file"])
+            files.append(project["layers"][layerId]["file"])
+            orders[layerId] = cache.load(files[-1])
+        if cache.misses > 0:
+            cache.save(files)
 
         # Compute bounding box
-        minX = maxX = minY = maxY = 0
-        for order in orders[orders.keys()[0]]:
-            if len(order) == 2:
-                minX = maxX = order[0]
-                minY = maxY = order[1]
-        for layerId in orders.keys():
-            for order in orders[layerId]:
-                if len(order) == 2:
-                    x = order[0]
-                    y = order[1]
-                    if x < minX:
-                        minX = x
-                    elif x > maxX:
-                        maxX = x
-                    if y < minY:
-                        minY = y
-                    elif y > maxY:
-                        maxY = y
+        minX, minY, maxX, maxY = layersBounds(orders.keys())
         project["minX"] = minX
         project["minY"] = minY
         project["maxX"] = maxX
@@ -400,10 +451,7 @@ def cmd_load(args=None):
                 project["auto_offset"] = False
         if project["auto_offset"]:
             for layerId in orders.keys():
-                for order in orders[layerId]:
-                    if len(order) == 2:
-                        order[0] = order[0] - minX
-                        order[1] = order[1] - minY
+                orders[layerId].offset(-minX, -minY)
             project["minX"] = 0
             project["minY"] = 0
             project["maxX"] = maxX - minX
@@ -420,6 +468,17 @@ def cmd_plot(args):
     scale = 31
     margin = 5
 
+    # Output file, to plot without a window
+    out = None
+    args = list(args)
+    if "--out" in args:
+        i = args.index("--out")
+        if i + 1 >= len(args) or not (args[i + 1].lower().endswith(".png") or args[i + 1].lower().endswith(".svg")):
+            print("Usage : plot [--out FILE.png|FILE.svg] [LAYER ...]")
+            return
+        out = args[i + 1]
+        del args[i:i + 2]
+
     # Layers to plot
     layers = []
     if len(args) == 1:
@@ -434,24 +493,30 @@ def cmd_plot(args):
                 return
 
     # Compute bounding box
-    minX = maxX = minY = maxY = 0
-    for order in orders[orders.keys()[0]]:
-        if len(order) == 2:
-            minX = maxX = order[0]
-            minY = maxY = order[1]
-    for layerId in orders.keys():
-        for order in orders[layerId]:
-            if len(order) == 2:
-                x = order[0]
-                y = order[1]
-                if x < minX:
-                    minX = x
-                elif x > maxX:
-                    maxX = x
-                if y < minY:
-                    minY = y
-                elif y > maxY:
-                    maxY = y
+    minX, minY, maxX, maxY = layersBounds(orders.keys())
+
+    # Prepare the layers, the first ones drawn on top
+    plotted = []
+    for layerId in layers:
+        if layerId in standardLayersColors.keys():
+            color = standardLayersColors[layerId]
+        else:
+            color = [0, 0, 0]
+        plotted.append((orders[layerId], color, project["layers"][layerId]["tool"]["diameter"]))
+
+    if out is not None and out.lower().endswith(".svg"):
+        Renderer.writeSvg(out, plotted, [minX, minY, maxX, maxY], margin)
+        print("Plot saved to " + out)
+        return
+
+    renderer = Renderer.Renderer([minX, minY, maxX, maxY], margin)
+    for toolpath, color, diameter in plotted:
+        renderer.addLayer(toolpath, color, diameter)
+
+    if out is not None:
+        renderer.save(out, scale)
+        print("Plot saved to " + out)
+        return
 
     # Init PyGame to display plots
     pygame.init()
@@ -489,45 +554,147 @@ def cmd_plot(args):
                     scale += 10
                     redraw = True
 
-        if redraw:
-            # Fill the background
-            pygameWindow.fill([255, 255, 255])
-
-            # Plot the origin
-            pygame.draw.line(pygameWindow, [0, 0, 0], [viewPos[0] + scale * margin - 20, viewPos[1] + sizeY - scale * margin], [viewPos[0] + scale * margin + 20, viewPos[1] + sizeY - scale * margin], 2)
-            pygame.draw.line(pygameWindow, [0, 0, 0], [viewPos[0] + scale * margin, viewPos[1] + sizeY - (scale * margin - 20)], [viewPos[0] + scale * margin, viewPos[1] + sizeY - (scale * margin + 20)], 2)
-            pygame.draw.circle(pygameWindow, [0, 0, 0], [viewPos[0] + scale * margin + 1, viewPos[1] + sizeY - (scale * margin + 1)], 10, 2)
-
-            # Plot the layers
-            for layerId in layers[::-1]:
-                if layerId in standardLayersColors.keys():
-                    color = standardLayersColors[layerId]
-                else:
-                    color = [0, 0, 0]
-                lastPos = None
-                size = int(round(scale * project["layers"][layerId]["tool"]["diameter"]))
-                up = True
-                for order in orders[layerId]:
-                    if len(order) == 1:
-                        if order[0] <= 0:
-                            up = False
-                            if lastPos is not None:
-                                pygame.draw.circle(pygameWindow, color, lastPos, int(size / 2 - 1))
-                        else:
-                            up = True
-                    elif len(order) == 2:
-                        currentPos = [int(round(viewPos[0] + scale * (margin + order[0]))), int(round(viewPos[1] + sizeY - scale * (margin + order[1])))]
-                        size_ = 2
-                        if not up:
-                            size_ = size
-                        pygame.draw.circle(pygameWindow, color, currentPos, int(size_ / 2 - 1))
-                        if lastPos is not None:
-                            pygame.draw.line(pygameWindow, color, lastPos, currentPos, size_)
-                            pygame.draw.circle(pygameWindow, color, lastPos, int(size_ / 2 - 1))
-                        lastPos = currentPos
+        if redraw and not exit:
+            # Only a change of scale renders the layers again
+            renderer.draw(pygameWindow, scale, viewPos, sizeY)
             pygame.display.flip()
             redraw = False
 
+def cmd_optimize(args):
+    if project["name"] == "":
+        print("Please create a project first")
+        return
+
+    if orders == {}:
+        cmd_load()
+
+    # Layers to optimize
+    layers = []
+    if len(args) == 1:
+        layers = project["layersOrder"]
+    else:
+        for layerId in args[1:]:
+            if layerId in project["layers"].keys():
+                layers.append(layerId)
+            else:
+                print("Unknown layer " + layerId)
+                return
+
+    # The head starts every layer at the origin of the project
+    start = (project["minX"], project["minY"])
+    for layerId in layers:
+        plunges = Optimizer.plungeCount(orders[layerId])
+        if layerId.startswith("Drill"):
+            orders[layerId], before, after = Optimizer.optimizeDrills(orders[layerId], start)
+        else:
+            orders[layerId], before, after = Optimizer.optimizeOrder(orders[layerId], start)
+        print(layerId + " : travel " + str(round(before, 1)) + "mm -> " + str(round(after, 1)) + "mm, plunges " + str(plunges) + " -> " + str(Optimizer.plungeCount(orders[layerId])))
+
+def cmd_simplify(args):
+    if project["name"] == "":
+        print("Please create a project first")
+        return
+
+    if orders == {}:
+        cmd_load()
+
+    # The tolerance is remembered in the project
+    args = args[1:]
+    if len(args) > 0 and re.match("^[0-9]*\.?[0-9]+$", args[0]):
+        project["tolerance"] = float(args[0])
+        args = args[1:]
+    tolerance = project.get("tolerance", simplifyTolerance)
+
+    # Layers to simplify
+    layers = []
+    if len(args) == 0:
+        layers = project["layersOrder"]
+    else:
+        for layerId in args:
+            if layerId in project["layers"].keys():
+                layers.append(layerId)
+            else:
+                print("Unknown layer " + layerId)
+                return
+
+    print("Tolerance : " + str(tolerance) + "mm")
+    for layerId in layers:
+        orders[layerId], removed, deviation = Simplifier.simplify(orders[layerId], tolerance)
+        print(layerId + " : " + str(removed) + " points removed, maximum deviation " + str(round(deviation * 1000, 2)) + "um")
+
+def cmd_dedup(args):
+    if project["name"] == "":
+        print("Please create a project first")
+        return
+
+    if orders == {}:
+        cmd_load()
+
+    # Layers to deduplicate
+    layers = []
+    if len(args) == 1:
+        layers = project["layersOrder"]
+    else:
+        for layerId in args[1:]:
+            if layerId in project["layers"].keys():
+                layers.append(layerId)
+            else:
+                print("Unknown layer " + layerId)
+                return
+
+    for layerId in layers:
+        orders[layerId], saved = Optimizer.removeDuplicates(orders[layerId])
+        print(layerId + " : " + str(round(saved, 1)) + "mm of duplicate cuts removed")
+
+def cmd_estimate(args):
+    if project["name"] == "":
+        print("Please create a project first")
+        return
+
+    if orders == {}:
+        cmd_load()
+
+    # Layers to estimate
+    layers = []
+    if len(args) == 1:
+        layers = project["layersOrder"]
+    else:
+        for layerId in args[1:]:
+            if layerId in project["layers"].keys():
+                layers.append(layerId)
+            else:
+                print("Unknown layer " + layerId)
+                return
+
+    speeds = motionSpeeds()
+    estimator = Estimator.Estimator(speeds, accelerated=mb.accelerated)
+    start = (project["minX"], project["minY"])
+    total = Estimator.LayerStats()
+    for layerId in layers + [None]:
+        if layerId is None:
+            # Whole job
+            stats = total
+            name = "Total"
+        else:
+            stats = estimator.estimateLayer(orders[layerId], start)
+            total.add(stats)
+            name = layerId
+        print(name + " : cut " + str(round(stats.cutLength, 1)) + "mm, travel " + str(round(stats.travelLength, 1)) + "mm, " + str(stats.plunges) + " plunges, " + str(stats.packets) + " packets, " + formatDuration(stats.duration))
+
+def cmd_motion(args):
+    if project["name"] == "":
+        print("Please create a project first")
+        return
+
+    # The mode is remembered in the project
+    if len(args) > 1:
+        if args[1] not in ["classic", "accelerated"]:
+            print("Usage : motion [classic|accelerated]")
+            return
+        project["motion"] = args[1]
+    motionSpeeds()
+    print("Motion mode : " + project.get("motion", "classic"))
+
 def cmd_move(args=[]):
     if not mb.isConnected():
         print("Machine not connected")
@@ -537,44 +704,14 @@ def cmd_move(args=[]):
         mb.move(args[1], args[2])
     else:
         print("Keys :")
-        print(" keyboard arrows : move the tool")
+        print(" keyboard arrows : move the tool, continuously while held down")
         print(" A/Q : raise/lower the buildplate")
         print(" +/- : increase/decrease the step")
-        fifo = [0, 0, 0]
-        speed = 1000
-        step = 2
-        steps = [0.1, 0.5, 1, 2, 5, 10]
-        while True:
-            sys.stdout.write("\rstep : " + str(steps[step]) + "mm, X : " + str(mb.position['x']) + "mm, Y : " + str(mb.position['y']) + "mm, Z : " + str(mb.position['z']) + "mm   ")
-            mb.wait()
-            key = ord(getch())
-            fifo[2] = fifo[1]
-            fifo[1] = fifo[0]
-            fifo[0] = key
-            if key in [3, 13, 22]:
-                #mb.stop()
-                print("")
-                break
-            elif fifo[2] == 27 and fifo[1] == 91:
-                # Escaping sequence
-                if fifo[0] == 65: # Up
-                    mb.move(0, steps[step], speed=speed, relative=True)
-                elif fifo[0] == 66: # Down
-                    mb.move(0, -steps[step], speed=speed, relative=True)
-                elif fifo[0] == 67: # Right
-                    mb.move(steps[step], 0, speed=speed, relative=True)
-                elif fifo[0] == 68: # Left
-                    mb.move(-steps[step], 0, speed=speed, relative=True)
-            elif key in [ord("a"), ord("A")]:
-                mb.moveZ(steps[step], speed=speed/2, relative=True)
-            elif key in [ord("q"), ord("Q")]:
-                mb.moveZ(-steps[step], speed=speed/2, relative=True)
-            elif key == ord("+"):
-                if step < len(steps) - 1:
-                    step += 1
-            elif key == ord("-"):
-                if step > 0:
-                    step -= 1
+        Jogger.Jogger(mb, getch).run()
+        print("")
+
+        # The head is where the user chose
+        mb.barrier()
 
 def cmd_run(args):
     if not mb.isConnected():
@@ -610,11 +747,18 @@ def cmd_run(args):
         offset['x'] = mb.position['x']
         offset['y'] = mb.position['y']
 
-    # Run every layer
+    # Remembered as the defaults of the exports
+    project["offset"] = offset
+
+    # Check the job before the first cut, the heights are checked once levelled
+    if not checkEnvelope(layers, offset):
+        return
+
+    # Run every layer, saving the progress to resume it if interrupted
+    checkpoint = Checkpoint.Checkpoint(project["name"] + ".mbcnc.checkpoint")
+    compiler = JobCompiler.JobCompiler(mb, motionSpeeds())
     currentTool = None
     buildplateZ = 0
-    travelHeight = 3
-    reversedOriginX = 71
     wasLastReversed = None
     for layerId in layers:
         layer = project["layers"][layerId]
@@ -634,8 +778,9 @@ def cmd_run(args):
             print("This layer uses the same tool, skipping tool change and levelling")
 
         else:
-            # Lower the buildplate
-            mb.moveZ(0)
+            # Lower the buildplate, and wait for it before asking anything
+            mb.enqueueZ(0)
+            mb.barrier()
 
             # Board side
             if wasLastReversed is None:
@@ -646,12 +791,12 @@ def cmd_run(args):
                 waitKey()
 
             # Move to the center
-            mb.wait()
-            mb.move(reversedOriginX / 2, 10)
+            mb.enqueueMove(reversedOriginX / 2, 10)
 
             if currentTool != layer["tool"]["description"]:
                 # Ask the user to change the tool
                 mb.hold(['x', 'y'])
+                mb.barrier()
                 print("Please put the following tool : " + layer["tool"]["description"])
                 waitKey()
                 currentTool = layer["tool"]["description"]
@@ -663,8 +808,9 @@ def cmd_run(args):
             maxY = project["maxY"] + offset['y']
             centerX = (minX + maxX) / 2.
             centerY = (minY + maxY) / 2.
-            mb.move(centerX, centerY)
-            mb.moveZ(70)
+            mb.enqueueMove(centerX, centerY)
+            mb.enqueueZ(70)
+            mb.barrier()
             print("Now we will level the buildplate.")
             print("Please tighten the levelling screws under the buildplate")
             waitKey()
@@ -676,7 +822,6 @@ def cmd_run(args):
             steps = [0.1, 0.5, 1, 2, 5, 10]
             while True:
                 sys.stdout.write("\rstep : " + str(steps[step]) + "mm, Z : " + str(mb.position['z']) + "mm   ")
-                mb.wait()
                 key = ord(getch())
                 fifo[2] = fifo[1]
                 fifo[1] = fifo[0]
@@ -690,98 +835,254 @@ def cmd_run(args):
                 elif fifo[2] == 27 and fifo[1] == 91:
                     # Escaping sequence
                     if fifo[0] == 65: # Up
-                        mb.moveZ(steps[step], speed=speed, relative=True)
+                        mb.enqueueZ(steps[step], speed=speed, relative=True)
                     elif fifo[0] == 66: # Down
-                        mb.moveZ(-steps[step], speed=speed, relative=True)
+                        mb.enqueueZ(-steps[step], speed=speed, relative=True)
                 elif key == ord("+"):
                     if step < len(steps):
                         step += 1
                 elif key == ord("-"):
                     if step > 0:
                         step -= 1
+                mb.flush()
             buildplateZ = mb.position['z']
+            project.setdefault("buildplateZ", {})[currentTool] = buildplateZ
             print("Fine-tune the levelling by untightening the screws until the tool barely touches")
-            mb.moveZ(buildplateZ - travelHeight, speed)
-            mb.move(minX, minY)
-            mb.moveZ(buildplateZ, speed)
-            mb.wait()
-            waitKey()
-            mb.moveZ(buildplateZ - travelHeight, speed)
-            mb.move(maxX, minY)
-            mb.wait()
-            mb.moveZ(buildplateZ, speed)
-            waitKey()
-            mb.moveZ(buildplateZ - travelHeight, speed)
-            mb.move(centerX, maxY)
-            mb.moveZ(buildplateZ, speed)
-            mb.wait()
-            waitKey()
+            for x, y in [(minX, minY), (maxX, minY), (centerX, maxY)]:
+                mb.enqueueZ(buildplateZ - travelHeight, speed)
+                mb.enqueueMove(x, y)
+                mb.enqueueZ(buildplateZ, speed)
+                mb.barrier()
+                waitKey()
 
             # Move back to origin
-            mb.moveZ(buildplateZ - travelHeight)
-            mb.wait()
+            mb.enqueueZ(buildplateZ - travelHeight)
             x = minX
             if isReversed:
                 x = reversedOriginX - x
-            mb.move(x, minY)
+            mb.enqueueMove(x, minY)
+            mb.flush()
         
-        # Ask the user to start the motor
+        # Check the depths of the layer with the levelled buildplate. The
+        # checkpoint of an interrupted run is kept.
+        if not checkEnvelope([layerId], offset, {currentTool: buildplateZ}):
+            mb.release()
+            mb.moveZ(0)
+            return
+
+        # Compile the layer before the spindle starts
+        print("Compiling layer " + layerId + "...")
+        program = compiler.compileLayer(layerId, orders[layerId], offset, buildplateZ, isReversed, reversedOriginX)
+
+        # Ask the user to start the motor once the head is in place
+        mb.barrier()
         print("When you are ready, put your safety glasses on, start the motor and press Enter!")
         waitKey()
 
-        # Send order sequences
-        print("Building, please don't interrupt...")
-        print "0%",
-        feedrate = 3000
-        travelSpeed = 500
-        zspeedUp = 400
-        zspeedDown = 3000
-        up = True
-        n = len(orders[layerId])
-        i = 0
-        for order in orders[layerId]:
-            print "\r" + str(int(i * 100 / n)) + "%",
-            sys.stdout.flush()
-            if len(order) == 1:
-                speed = 0
-                if order[0] > 0:
-                    up = True
-                    speed = zspeedUp
-                else:
-                    up = False
-                    speed = zspeedDown
-                mb.wait()
-                mb.moveZ(buildplateZ - order[0], speed)
-                mb.wait()
-            elif len(order) == 2:
-                speed = 0
-                if up:
-                    speed = travelSpeed
-                else:
-                    speed = feedrate
-                x = offset['x'] + order[0]
-                y = offset['y'] + order[1]
-                if isReversed:
-                    x = reversedOriginX - x
-                mb.move(x, y, speed)
-            i += 1
+        # Send the compiled packets
+        state = {
+            "layer" : layerId,
+            "digest" : orders[layerId].digest(),
+            "order" : 0,
+            "offset" : offset,
+            "buildplateZ" : buildplateZ,
+            "reversed" : isReversed,
+            "remaining" : layers[layers.index(layerId) + 1:]
+        }
+        if not sendLayer(program, checkpoint, state):
+            return
 
         # Move back to origin
-        mb.moveZ(buildplateZ - travelHeight)
-        mb.wait()
+        mb.enqueueZ(buildplateZ - travelHeight)
         x = offset['x']
         y = offset['y']
         if isReversed:
             x = reversedOriginX - x
-        mb.move(x, y)
+        mb.enqueueMove(x, y)
+        mb.flush()
 
         wasLastReversed = isReversed
 
     mb.release()
     mb.moveZ(0)
+    checkpoint.clear()
     print("")
     print("Done!")
 
+## Send a compiled layer to the machine, showing the progress and saving a
+## checkpoint of the orders completed. The order i of the program is the order
+## firstOrder + i of the layer, which has nOrders orders. Return False if the
+## transmission failed and the machine was stopped, to be resumed later.
+def sendLayer(program, checkpoint, state, firstOrder=0, nOrders=None):
+    if nOrders is None:
+        nOrders = program.nOrders
+    print("Building, please don't interrupt...")
+    print "0%",
+    progress = {"percent" : 0}
+    def onAck(i):
+        p = int((firstOrder + program.orders[i]) * 100 / nOrders)
+        if p != progress["percent"]:
+            progress["percent"] = p
+            print "\r" + str(p) + "%",
+            sys.stdout.flush()
+        # The packets still pending are not started, and the last one started
+        # may not be over : resume from it
+        started = i + 1 - mb.pendingCount()
+        state["order"] = max(firstOrder + program.orders[max(started - 1, 0)], state["order"])
+        checkpoint.update(state)
+    checkpoint.update(state, True)
+    try:
+        mb.runProgram(program, pipelineDepth, onAck)
+    except makerbot_driver.TransmissionError as e:
+        # The machine was stopped : the layer can be resumed from the last
+        # order started
+        checkpoint.update(state, True)
+        print("")
+        print("Transmission error : " + str(e) + ", the machine was stopped at order " + str(state["order"]))
+        print("Please stop the motor, then use resume to finish the layer")
+        return False
+    state["order"] = firstOrder + program.nOrders
+    checkpoint.update(state, True)
+    return True
+
+def cmd_resume(args):
+    if project["name"] == "":
+        print("Please create a project first")
+        return
+
+    if not mb.isConnected():
+        print("Machine not connected")
+        return
+
+    checkpoint = Checkpoint.Checkpoint(project["name"] + ".mbcnc.checkpoint")
+    state = checkpoint.load()
+    if state is None:
+        print("No interrupted run to resume")
+        return
+
+    if orders == {}:
+        cmd_load()
+
+    layerId = state["layer"]
+    if layerId not in orders:
+        print("Unknown layer " + layerId)
+        return
+    toolpath = orders[layerId]
+    if toolpath.digest() != state["digest"]:
+        print("The orders of layer " + layerId + " changed since the run, please load and optimize it the same way")
+        return
+    order = state["order"]
+    offset = state["offset"]
+    buildplateZ = state["buildplateZ"]
+    isReversed = state["reversed"]
+    print("Resuming layer " + layerId + " at order " + str(order) + " of " + str(len(toolpath)))
+    if order >= len(toolpath):
+        print("This layer was completed")
+    else:
+        # Home the machine : the buildplate height stays valid
+        print("Homing the machine...")
+        mb.home()
+
+        # Retract, then go above the position before the order
+        mb.moveZ(buildplateZ - travelHeight)
+        x = offset['x']
+        y = offset['y']
+        if order > 0:
+            x += toolpath.x[order - 1]
+            y += toolpath.y[order - 1]
+        if isReversed:
+            x = reversedOriginX - x
+        mb.move(x, y)
+
+        # Plunge again if the order is a cut
+        rest = Toolpath.Toolpath()
+        firstOrder = order
+        if toolpath.op[order] == Toolpath.MOVE_XY and toolpath.z[order] <= 0:
+            rest.appendZ(toolpath.z[order])
+            firstOrder -= 1
+        rest.extend(toolpath, order)
+
+        compiler = JobCompiler.JobCompiler(mb, motionSpeeds())
+        program = compiler.compileLayer(layerId, rest, offset, buildplateZ, isReversed, reversedOriginX)
+        print("When you are ready, put your safety glasses on, start the motor and press Enter!")
+        waitKey()
+        if not sendLayer(program, checkpoint, state, firstOrder, len(toolpath)):
+            return
+
+        # Move back to origin
+        mb.moveZ(buildplateZ - travelHeight)
+        x = offset['x']
+        if isReversed:
+            x = reversedOriginX - x
+        mb.move(x, offset['y'])
+        mb.barrier()
+
+    print("")
+    if len(state["remaining"]) > 0:
+        print("Remaining layers : " + " ".join(state["remaining"]))
+        print("Use run " + " ".join(state["remaining"]) + " to make them")
+    else:
+        print("Done!")
+        mb.release()
+        checkpoint.clear()
+
+def cmd_export(args):
+    if project["name"] == "":
+        print("Please create a project first")
+        return
+
+    if len(args) < 2 or not (args[1].lower().endswith(".s3g") or args[1].lower().endswith(".x3g")):
+        print("Usage : export FILE.s3g|FILE.x3g [LAYER ...]")
+        return
+
+    if orders == {}:
+        cmd_load()
+
+    # Layers to export
+    layers = []
+    if len(args) == 2:
+        layers = project["layersOrder"]
+    else:
+        for layerId in args[2:]:
+            if layerId in project["layers"].keys():
+                layers.append(layerId)
+            else:
+                print("Unknown layer " + layerId)
+                return
+
+    # Without a machine to level the buildplate, use the values of the last run
+    offset = project.get("offset", {'x' : 0, 'y' : 0})
+    offset = {
+        'x' : ask("Position offset X [" + str(offset['x']) + "] : ", default=offset['x'], type=float),
+        'y' : ask("Position offset Y [" + str(offset['y']) + "] : ", default=offset['y'], type=float)
+    }
+    buildplateZ = {}
+    for layerId in layers:
+        tool = project["layers"][layerId]["tool"]["description"]
+        if tool not in buildplateZ:
+            z = project.get("buildplateZ", {}).get(tool)
+            if z is None:
+                buildplateZ[tool] = ask("Buildplate height touching the " + tool + " : ", type=float)
+            else:
+                buildplateZ[tool] = ask("Buildplate height touching the " + tool + " [" + str(z) + "] : ", default=z, type=float)
+
+    if not checkEnvelope(layers, offset, buildplateZ):
+        return
+
+    print("Exporting to " + args[1] + "...")
+    # The .x3g files are always accelerated
+    speeds = runSpeeds
+    if args[1].lower().endswith(".x3g"):
+        speeds = acceleratedSpeeds
+    exporter = Exporter.JobExporter(args[1], speeds, travelHeight, reversedOriginX)
+    job = []
+    for layerId in layers:
+        layer = project["layers"][layerId]
+        job.append((layerId, orders[layerId], layer["tool"]["description"], layer["reversed"]))
+    bounds = [project["minX"], project["minY"], project["maxX"], project["maxY"]]
+    exporter.export(project["name"], job, offset, bounds, buildplateZ)
+    print("Done!")
+
 
 def cmd_exit(args=None):
     if project["name"] != "":
@@ -798,6 +1099,7 @@ if __name__ == "__main__":
 
     # Try to load an existing project
     autoLoadProject()
+    motionSpeeds()
 
     while True:
         try:
@@ -806,6 +1108,11 @@ if __name__ == "__main__":
             cmd_exit()
         if len(command) > 0:
             if command[0] in commands:
-                locals()["cmd_" + command[0]](command)
+                try:
+                    locals()["cmd_" + command[0]](command)
+                except makerbot_driver.TransmissionError as e:
+                    # The connection failed for good, the machine was stopped
+                    print("")
+                    print("Transmission error : " + str(e))
             else:
                 print("Unknown command : " + command[0])
\ No newline at end of file
@@ -0,0 +1,88 @@
+import unittest
+import makerbot_driver
+
+
+class FakeWriter:
+    """Acknowledges the packets sent, each call running the next failure of
+failures, an (acknowledged count, exception) pair, None when all pass"""
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.sent = []
+
+    def send_packets(self, packets, window_size=None, callback=None):
+        self.sent.append(list(packets))
+        failure = self.failures.pop(0) if self.failures else None
+        for i in range(len(packets)):
+            if failure is not None and i == failure[0]:
+                raise failure[1]
+            callback(i)
+
+
+class FakeS3g:
+    """Machine reporting a free space of available bytes in its buffer"""
+    def __init__(self, failures=[]):
+        self.writer = FakeWriter(failures)
+        self.available = 512
+        self.queries = 0
+
+    def get_available_buffer_size(self):
+        self.queries += 1
+        return self.available
+
+
+def packets(count, size=10):
+    return [makerbot_driver.Encoder.encode_payload(bytearray([155] + [0] * (size - 1))) for i in range(count)]
+
+
+class SendPacketsTest(unittest.TestCase):
+    def test_overflow_then_retry(self):
+        s3g = FakeS3g([(2, makerbot_driver.BufferOverflowError())])
+        queue = makerbot_driver.ActionQueue(s3g, min_delay=0.001)
+        acked = []
+        sent = packets(4)
+        queue.send_packets(sent, [0.001] * 4, 4, acked.append)
+        # The packets from the rejected one are sent again, after a query
+        self.assertEqual(s3g.writer.sent, [sent, sent[2:]])
+        self.assertEqual(acked, [0, 1, 2, 3])
+        self.assertEqual(queue.total_overflows, 1)
+        self.assertEqual(s3g.queries, 2)
+
+    def test_model_after_acks(self):
+        s3g = FakeS3g()
+        queue = makerbot_driver.ActionQueue(s3g)
+        queue.send_packets(packets(3), [10] * 3)
+        # The first move runs, the payloads of the others fill the buffer
+        self.assertEqual(queue.pending_count(), 2)
+        self.assertEqual(queue.free, 512 - 20)
+        # The machine took the second one out of its buffer
+        s3g.available = 512 - 10
+        queue.sync()
+        self.assertEqual(queue.free, 512 - 10)
+        self.assertEqual(queue.pending_count(), 1)
+
+    def test_waits_for_room(self):
+        s3g = FakeS3g()
+        s3g.available = 20
+        queue = makerbot_driver.ActionQueue(s3g, min_delay=0.001)
+        acked = []
+        # Two packets fit, a third once the first move runs, the last one
+        # once the second move should have started
+        queue.send_packets(packets(4), [0.05] * 4, callback=acked.append)
+        self.assertEqual([len(batch) for batch in s3g.writer.sent], [2, 1, 1])
+        self.assertEqual(acked, [0, 1, 2, 3])
+        self.assertEqual(queue.total_waits, 1)
+
+    def test_reset_after_preempted(self):
+        s3g = FakeS3g([(1, makerbot_driver.PreemptedError())])
+        queue = makerbot_driver.ActionQueue(s3g)
+        self.assertRaises(makerbot_driver.PreemptedError, queue.send_packets, packets(3), [10] * 3)
+        self.assertEqual(queue.pending_count(), 0)
+        self.assertEqual(queue.capacity, None)
+        # The buffer is queried again before sending
+        queue.send_packets(packets(1), [10])
+        self.assertEqual(s3g.queries, 2)
+        self.assertEqual(queue.free, 512 - 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
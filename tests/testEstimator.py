@@ -0,0 +1,57 @@
+import unittest
+import Toolpath
+import Makerbot
+import JobCompiler
+import Estimator
+
+speeds = {
+    "feedrate" : 2000,
+    "travel" : 0,
+    "zUp" : 0,
+    "zDown" : 3000
+}
+
+
+def square(x, y, size, depth):
+    toolpath = Toolpath.Toolpath()
+    toolpath.appendZ(2)
+    toolpath.appendXY(x, y)
+    toolpath.appendZ(depth)
+    for px, py in [(x + size, y), (x + size, y + size), (x, y + size), (x, y)]:
+        toolpath.appendXY(px, py)
+    toolpath.appendZ(2)
+    return toolpath
+
+
+class EstimateLayerTest(unittest.TestCase):
+    def compiledDuration(self, toolpath, accelerated):
+        mb = Makerbot.Makerbot()
+        mb.loadProfile("The Replicator 2")
+        mb.accelerated = accelerated
+        buildplateZ = 50
+        mb.position = {'x' : 10, 'y' : 10, 'z' : buildplateZ - 3}
+        layer = JobCompiler.JobCompiler(mb, speeds).compileLayer("F.Cu", toolpath, {'x' : 0, 'y' : 0}, buildplateZ, False, 0)
+        return sum(layer.durations)
+
+    def test_lengths(self):
+        stats = Estimator.Estimator(speeds).estimateLayer(square(20, 10, 5, -1), (10, 10))
+        self.assertEqual(stats.packets, 8)
+        self.assertEqual(stats.plunges, 1)
+        self.assertAlmostEqual(stats.travelLength, 10)
+        self.assertAlmostEqual(stats.cutLength, 20)
+
+    def test_classic_matches_compiled(self):
+        # The speeds faster than the profile allows are sent as they are
+        toolpath = square(20, 10, 5, -1)
+        stats = Estimator.Estimator(speeds).estimateLayer(toolpath, (10, 10))
+        self.assertAlmostEqual(stats.duration, self.compiledDuration(toolpath, False))
+
+    def test_accelerated_matches_compiled(self):
+        toolpath = square(20, 10, 5, -1)
+        stats = Estimator.Estimator(speeds, accelerated=True).estimateLayer(toolpath, (10, 10))
+        self.assertAlmostEqual(stats.duration, self.compiledDuration(toolpath, True))
+        self.assertTrue(stats.duration > Estimator.Estimator(speeds).estimateLayer(toolpath, (10, 10)).duration)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import sys
+import time
+import threading
+import StringIO
+import unittest
+import Jogger
+
+UP = "\x1b[A"
+ENTER = "\r"
+
+
+class FakeMakerbot:
+    """Records the moves queued by the jogger, each taking Jogger.SEGMENT
+seconds once flushed"""
+    def __init__(self):
+        self.position = {'x' : 0, 'y' : 0, 'z' : 0}
+        self.amplitude = {'x' : 190, 'y' : 43, 'z' : 100}
+        self.spm = {'x' : 88.888889, 'y' : 88.888889, 'z' : 400}
+        self.busyUntil = 0
+        self.moves = []
+        self.queued = 0
+        self.halts = 0
+
+    def enqueueMove(self, x, y, speed=300):
+        self.position['x'] = x
+        self.position['y'] = y
+        self.moves.append(('xy', x, y))
+        self.queued += 1
+
+    def enqueueZ(self, z, speed=100):
+        self.position['z'] = z
+        self.moves.append(('z', z))
+        self.queued += 1
+
+    def flush(self):
+        self.busyUntil = max(self.busyUntil, time.time()) + self.queued * Jogger.SEGMENT
+        self.queued = 0
+
+    def halt(self):
+        self.halts += 1
+        self.queued = 0
+        self.busyUntil = 0
+
+
+def keySource(script):
+    """readKey returning the characters of script, each (delay, keys) pair
+typed after delay seconds"""
+    chars = []
+    for delay, keys in script:
+        for k, char in enumerate(keys):
+            chars.append((delay if k == 0 else 0, char))
+    def readKey():
+        if not chars:
+            # Nothing more is typed
+            threading.Event().wait()
+        delay, char = chars.pop(0)
+        time.sleep(delay)
+        return char
+    return readKey
+
+
+class JoggerTest(unittest.TestCase):
+    def jog(self, script, mb=None):
+        if mb is None:
+            mb = FakeMakerbot()
+        jogger = Jogger.Jogger(mb, keySource(script))
+        # Hide the status line
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            jogger.run()
+        finally:
+            sys.stdout = stdout
+        return mb
+
+    def test_single_press(self):
+        mb = self.jog([(0, UP), (0, ENTER)])
+        # Moved by the default step of 1mm
+        self.assertEqual(mb.moves, [('xy', 0, 1)])
+        self.assertEqual(mb.halts, 0)
+
+    def test_held_key(self):
+        # The key repeats, then is released for longer than RELEASE_DELAY
+        mb = self.jog([(0, UP), (0.02, UP), (0.02, UP), (3 * Jogger.RELEASE_DELAY, ENTER)])
+        self.assertTrue(len(mb.moves) > 2)
+        ys = [move[2] for move in mb.moves]
+        self.assertEqual(ys, sorted(ys))
+        self.assertEqual(mb.halts, 1)
+
+    def test_exit_while_held(self):
+        mb = self.jog([(0, UP), (0.02, UP), (0, ENTER)])
+        self.assertEqual(mb.halts, 1)
+
+    def test_limit(self):
+        mb = FakeMakerbot()
+        mb.position['y'] = mb.amplitude['y']
+        self.jog([(0, UP), (0, ENTER)], mb)
+        self.assertEqual(mb.moves, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import makerbot_driver
+import Makerbot
+
+
+class FakeDriver:
+    """Stands for the s3g object of a machine stopped with its head at home"""
+    def __init__(self):
+        self.stops = 0
+
+    def extended_stop(self, halt_steppers, clear_buffer):
+        self.stops += 1
+
+    def get_extended_position(self):
+        return [0, 0, 0, 0, 0], 0
+
+    def get_available_buffer_size(self):
+        return 512
+
+
+class FailingWriter:
+    """Stream whose packets after the first one run out of order"""
+    def send_packets(self, packets, window_size=None, callback=None):
+        callback(0)
+        raise makerbot_driver.OutOfOrderError(["CRCMismatchError"], 1)
+
+
+class Program(list):
+    """Compiled program of packets lasting one second each"""
+    def __init__(self, packets):
+        list.__init__(self, packets)
+        self.durations = [1] * len(packets)
+        self.duration = len(packets)
+        self.position = {'x' : 10, 'y' : 10, 'z' : 0}
+
+
+class RunProgramTest(unittest.TestCase):
+    def test_stops_out_of_order(self):
+        mb = Makerbot.Makerbot()
+        mb.loadProfile("The Replicator 2")
+        mb.driver = FakeDriver()
+        mb.driver.writer = FailingWriter()
+        mb.actions = makerbot_driver.ActionQueue(mb.driver)
+        mb.connected = True
+        packets = [makerbot_driver.Encoder.encode_payload(bytearray([137, i])) for i in range(4)]
+        try:
+            mb.runProgram(Program(packets), 4)
+            self.fail("OutOfOrderError not raised")
+        except makerbot_driver.OutOfOrderError as e:
+            self.assertEqual(e.index, 1)
+        # The machine was stopped, and the head is where it stopped
+        self.assertEqual(mb.driver.stops, 1)
+        self.assertEqual(mb.actions.pending_count(), 0)
+        self.assertEqual(mb.position, {'x' : 190, 'y' : 43, 'z' : 100})
+
+
+class HaltTest(unittest.TestCase):
+    def test_resets_action_queue(self):
+        mb = Makerbot.Makerbot()
+        mb.loadProfile("The Replicator 2")
+        mb.driver = FakeDriver()
+        mb.actions = makerbot_driver.ActionQueue(mb.driver)
+        mb.connected = True
+        mb.actions.sync()
+        mb.actions._queued(32, 10)
+        mb.halt()
+        self.assertEqual(mb.driver.stops, 1)
+        self.assertEqual(mb.actions.pending_count(), 0)
+        self.assertEqual(mb.actions.capacity, None)
+        self.assertEqual(mb.position, {'x' : 190, 'y' : 43, 'z' : 100})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import Toolpath
+import Optimizer
+
+
+def passes(depths, x=10, y=10, size=5, toolpath=None):
+    """A square contour cut once at each depth, the tool raised in between"""
+    if toolpath is None:
+        toolpath = Toolpath.Toolpath()
+        toolpath.appendZ(2)
+    for depth in depths:
+        toolpath.appendXY(x, y)
+        toolpath.appendZ(depth)
+        for px, py in [(x + size, y), (x + size, y + size), (x, y + size), (x, y)]:
+            toolpath.appendXY(px, py)
+        toolpath.appendZ(2)
+    return toolpath
+
+
+def zOrders(toolpath):
+    return [z for op, z in zip(toolpath.op, toolpath.z) if op == Toolpath.MOVE_Z]
+
+
+class JoinChainsTest(unittest.TestCase):
+    def test_same_depth(self):
+        chains, travelZ = Optimizer.splitChains(passes([-0.5, -0.5]))
+        self.assertEqual(len(Optimizer.joinChains(chains)), 1)
+
+    def test_different_depths(self):
+        chains, travelZ = Optimizer.splitChains(passes([-0.5, -1.0, -1.5]))
+        joined = Optimizer.joinChains(chains)
+        self.assertEqual(sorted(chain.depth() for chain in joined), [-1.5, -1.0, -0.5])
+
+
+class OrderChainsTest(unittest.TestCase):
+    def test_reverse_first_chain(self):
+        # Cutting the first chain from its far end leaves the tool closer to
+        # the second one
+        toolpath = Toolpath.Toolpath()
+        toolpath.appendZ(2)
+        for x0, y0, x1, y1 in [(1, 1, 2, 0), (2, 4, 6, 9)]:
+            toolpath.appendXY(x0, y0)
+            toolpath.appendZ(-1)
+            toolpath.appendXY(x1, y1)
+            toolpath.appendZ(2)
+        chains, travelZ = Optimizer.splitChains(toolpath)
+        ordered = Optimizer.orderChains(chains, neighbours=1)
+        self.assertEqual([chain.start() for chain in ordered], [(2, 0), (2, 4)])
+
+
+class OrderPointsTest(unittest.TestCase):
+    def test_reverse_from_start(self):
+        # The shortest path doesn't begin with the point closest to the
+        # start : only a reversal from the first position of the tour finds it
+        xs = [6.0, 8.0, 2.0, 0.0]
+        ys = [9.0, 3.0, 8.0, 10.0]
+        self.assertEqual(Optimizer.orderPoints(xs, ys, neighbours=2), [1, 0, 2, 3])
+
+
+class OptimizeOrderTest(unittest.TestCase):
+    def assertShallowFirst(self, toolpath):
+        # Every segment is cut at its shallowest depth first
+        depths = {}
+        px = py = None
+        for op, x, y, z in zip(toolpath.op, toolpath.x, toolpath.y, toolpath.z):
+            if op == Toolpath.MOVE_XY and z <= 0:
+                key = tuple(sorted([(px, py), (x, y)]))
+                self.assertTrue(z <= depths.get(key, 0), "%s cut at %s after %s" % (key, z, depths.get(key)))
+                depths[key] = z
+            px, py = x, y
+
+    def test_passes_stay_shallow_first(self):
+        # The contours far from the start are split around the passes in the
+        # file, so the cuts are reordered
+        toolpath = passes([-0.5], x=100)
+        passes([-0.5, -1.0, -1.5], toolpath=toolpath)
+        passes([-0.5], x=100, y=30, toolpath=toolpath)
+        result, before, after = Optimizer.optimizeOrder(toolpath)
+        self.assertTrue(after < before)
+        self.assertShallowFirst(result)
+        plunges = [z for z in zOrders(result) if z <= 0]
+        self.assertEqual(plunges, [-0.5, -0.5, -0.5, -1.0, -1.5])
+
+    def test_passes_over_several_contours(self):
+        toolpath = passes([-0.5, -1.0], x=50)
+        passes([-0.5, -1.0], x=10, toolpath=toolpath)
+        passes([-0.5, -1.0], x=30, toolpath=toolpath)
+        result, before, after = Optimizer.optimizeOrder(toolpath)
+        self.assertShallowFirst(result)
+        self.assertEqual(Optimizer.plungeCount(result), 6)
+
+    def test_drills_by_depth(self):
+        toolpath = Toolpath.Toolpath()
+        toolpath.appendZ(2)
+        for x, depth in [(0, -1.0), (20, -1.0), (0, -2.0)]:
+            toolpath.appendXY(x, 0)
+            toolpath.appendZ(depth)
+            toolpath.appendZ(2)
+        result, before, after = Optimizer.optimizeDrills(toolpath)
+        plunges = [(x, z) for op, x, z in zip(result.op, result.x, result.z) if op == Toolpath.MOVE_Z and z <= 0]
+        self.assertTrue(plunges.index((0, -1.0)) < plunges.index((0, -2.0)))
+
+
+if __name__ == "__main__":
+    unittest.main()
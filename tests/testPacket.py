@@ -0,0 +1,23 @@
+import unittest
+import makerbot_driver
+from makerbot_driver import Encoder
+
+
+class PacketStreamDecoderTest(unittest.TestCase):
+    def test_chunks(self):
+        packet = str(Encoder.encode_payload(bytearray([0x81, 1, 2])))
+        decoder = Encoder.PacketStreamDecoder()
+        self.assertEqual(decoder.feed(packet[:2]), [])
+        self.assertEqual(decoder.feed(packet[2:] + packet), [bytearray([0x81, 1, 2])] * 2)
+
+    def test_keeps_packets_before_error(self):
+        packet = str(Encoder.encode_payload(bytearray([0x81, 1, 2])))
+        decoder = Encoder.PacketStreamDecoder()
+        self.assertRaises(makerbot_driver.PacketHeaderError, decoder.feed, packet + '\x00' + packet)
+        self.assertEqual(decoder.ready, [bytearray([0x81, 1, 2])])
+        self.assertEqual(decoder.feed(''), [bytearray([0x81, 1, 2])] * 2)
+        self.assertEqual(decoder.ready, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import Toolpath
+import Renderer
+
+
+class TilesOfTest(unittest.TestCase):
+    def test_rectangle(self):
+        self.assertEqual(Renderer.tilesOf(-1, 5, 12, 9), [(-1, 0), (0, 0), (1, 0)])
+
+
+class TileIndexTest(unittest.TestCase):
+    def test_chunks(self):
+        xs = [float(i) for i in range(150)]
+        ys = [0.] * 150
+        index = Renderer.TileIndex([(True, xs, ys)], 0.5)
+        # Chunks of CHUNK_POINTS points sharing their endpoints, the caps on
+        # the ends of the polyline
+        self.assertEqual([len(chunk[1]) for chunk in index.chunks], [64, 64, 24])
+        self.assertEqual(index.chunks[0][1][-1], index.chunks[1][1][0])
+        self.assertEqual([(chunk[3], chunk[4]) for chunk in index.chunks], [(True, False), (False, False), (False, True)])
+
+    def test_tiles_widened_by_radius(self):
+        # A segment along y = 0 also shows on the tiles below it, within the
+        # tool radius
+        index = Renderer.TileIndex([(True, [1., 8.], [0., 0.])], 0.5)
+        self.assertEqual(index.tiles, {(0, -1) : [0], (0, 0) : [0]})
+
+
+class RenderedLayerTest(unittest.TestCase):
+    def layer(self):
+        toolpath = Toolpath.Toolpath()
+        toolpath.appendZ(2)
+        toolpath.appendXY(5, 5)
+        toolpath.appendZ(-1)
+        toolpath.appendXY(25, 5)
+        toolpath.appendXY(25, 5.001)
+        toolpath.appendXY(25, 15)
+        toolpath.appendZ(2)
+        return Renderer.RenderedLayer(toolpath, [0, 0, 0], 1)
+
+    def test_runs_and_plunges(self):
+        layer = self.layer()
+        self.assertEqual([(cut, len(xs)) for cut, xs, ys in layer.runs], [(False, 1), (True, 4)])
+        self.assertEqual(layer.plunges, {(0, 0) : [(5, 5)]})
+
+    def test_levels_of_detail(self):
+        layer = self.layer()
+        self.assertEqual(len(layer.index(0).chunks[1][1]), 4)
+        # The point 0.001mm off the segment is dropped at coarser levels
+        self.assertEqual(len(layer.index(0.005).chunks[1][1]), 3)
+        self.assertTrue(layer.index(0.005) is layer.index(0.005))
+
+
+class ToleranceTest(unittest.TestCase):
+    def test_half_pixel(self):
+        renderer = Renderer.Renderer([0, 0, 10, 10])
+        # The coarsest level within half a pixel, full detail when zoomed in
+        self.assertEqual(renderer.tolerance(11), 0.02)
+        self.assertEqual(renderer.tolerance(31), 0.01)
+        self.assertEqual(renderer.tolerance(51), 0.005)
+        self.assertEqual(renderer.tolerance(101), 0)
+
+    def test_levels_used(self):
+        # Every level is used by some scale of the zoom range
+        renderer = Renderer.Renderer([0, 0, 10, 10])
+        used = set(renderer.tolerance(scale) for scale in range(11, 102, 10))
+        self.assertTrue(set(Renderer.LOD_TOLERANCES) <= used)
+
+
+if __name__ == "__main__":
+    unittest.main()
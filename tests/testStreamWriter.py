@@ -0,0 +1,232 @@
+import time
+import struct
+import threading
+import unittest
+import makerbot_driver
+from makerbot_driver import Encoder
+
+
+class FakePort:
+    """Serial port returning the bytes of incoming, and recording the
+packets written"""
+    def __init__(self, incoming=''):
+        self.incoming = bytearray(incoming)
+        self.written = bytearray()
+
+    def write(self, data):
+        self.written.extend(data)
+
+    def flush(self):
+        pass
+
+    def inWaiting(self):
+        return len(self.incoming)
+
+    def read(self, n):
+        data = str(self.incoming[:n])
+        del self.incoming[:n]
+        return data
+
+    def flushInput(self):
+        self.incoming = bytearray()
+
+    def isOpen(self):
+        return True
+
+
+def response(*payload):
+    return str(Encoder.encode_payload(bytearray(payload)))
+
+
+SUCCESS = makerbot_driver.response_code_dict['SUCCESS']
+OVERFLOW = makerbot_driver.response_code_dict['ACTION_BUFFER_OVERFLOW']
+CRC_MISMATCH = makerbot_driver.response_code_dict['CRC_MISMATCH']
+BUFFER_SIZE = makerbot_driver.host_query_command_dict['GET_AVAILABLE_BUFFER_SIZE']
+EXTENDED_STOP = makerbot_driver.host_query_command_dict['EXTENDED_STOP']
+
+
+def action(i):
+    """Action packet tagged with i"""
+    return Encoder.encode_payload(bytearray([makerbot_driver.host_action_command_dict['ENABLE_AXES'], i]))
+
+
+class FakeMachine(FakePort):
+    """Answers each packet delay seconds after it is written : the buffer size
+query with 512 bytes, the extended stop with success, and the action packets
+with the code scripted for their tag and attempt, SUCCESS by default, or a
+(code, late) pair for a response coming late seconds later than the others.
+The tags of the action packets are recorded in received, the other packets as
+'query' and 'stop'."""
+    def __init__(self, script={}, delay=0):
+        FakePort.__init__(self)
+        self.script = script
+        self.delay = delay
+        self.received = []
+        self.answers = []
+        self.lock = threading.Lock()
+
+    def _answer(self, data, late=0):
+        self.answers.append((time.time() + self.delay + late, data))
+
+    def _arrived(self):
+        now = time.time()
+        while self.answers and self.answers[0][0] <= now:
+            self.incoming.extend(self.answers.pop(0)[1])
+
+    def write(self, data):
+        with self.lock:
+            FakePort.write(self, data)
+            while len(self.written) >= 2 and len(self.written) >= self.written[1] + 3:
+                packet = self.written[:self.written[1] + 3]
+                del self.written[:len(packet)]
+                if packet[2] == BUFFER_SIZE:
+                    self.received.append('query')
+                    self._answer(response(SUCCESS, *bytearray(struct.pack('<I', 512))))
+                elif packet[2] == EXTENDED_STOP:
+                    self.received.append('stop')
+                    self._answer(response(SUCCESS, 0))
+                else:
+                    tag = packet[3]
+                    attempt = self.received.count(tag)
+                    self.received.append(tag)
+                    code = self.script.get((tag, attempt), SUCCESS)
+                    late = 0
+                    if isinstance(code, tuple):
+                        code, late = code
+                    self._answer(response(code), late)
+
+    def inWaiting(self):
+        with self.lock:
+            self._arrived()
+            return FakePort.inWaiting(self)
+
+    def read(self, n):
+        with self.lock:
+            self._arrived()
+            return FakePort.read(self, n)
+
+    def flushInput(self):
+        with self.lock:
+            self._arrived()
+            FakePort.flushInput(self)
+
+
+class ReadResponseTest(unittest.TestCase):
+    def test_error_after_responses(self):
+        # Invalid bytes read along with valid responses fail the packet they
+        # answer, not the ones before it
+        port = FakePort(response(0x81, 1) + '\x00\x00' + response(0x81, 2))
+        writer = makerbot_driver.Writer.StreamWriter(port, threading.Condition())
+        self.assertEqual(writer._read_response(), bytearray([0x81, 1]))
+        self.assertRaises(makerbot_driver.PacketHeaderError, writer._read_response)
+        self.assertEqual(writer._read_response(), bytearray([0x81, 2]))
+
+
+
+class SendPacketsTest(unittest.TestCase):
+    def send(self, machine, count, window_size=3):
+        writer = makerbot_driver.Writer.StreamWriter(machine, threading.Condition())
+        acks = []
+        try:
+            writer.send_packets([action(i) for i in range(count)], window_size, acks.append)
+        finally:
+            self.acks = acks
+
+    def test_window(self):
+        machine = FakeMachine()
+        self.send(machine, 6)
+        self.assertEqual(machine.received, range(6))
+        self.assertEqual(self.acks, range(6))
+
+    def test_retry(self):
+        # The packet after the failed one is rejected too : the window is
+        # sent again from the failed packet
+        machine = FakeMachine({(1, 0) : CRC_MISMATCH, (2, 0) : OVERFLOW})
+        self.send(machine, 4, 2)
+        self.assertEqual(machine.received, [0, 1, 2, 'query', 1, 2, 3])
+        self.assertEqual(self.acks, range(4))
+
+    def test_overflow_raised(self):
+        machine = FakeMachine({(2, 0) : OVERFLOW, (3, 0) : OVERFLOW, (4, 0) : OVERFLOW})
+        self.assertRaises(makerbot_driver.BufferOverflowError, self.send, machine, 6)
+        self.assertEqual(machine.received, [0, 1, 2, 3, 4, 'query'])
+        self.assertEqual(self.acks, [0, 1])
+
+    def test_out_of_order(self):
+        # The machine took the packets after the failed one : sending it
+        # again would run it after them
+        machine = FakeMachine({(1, 0) : CRC_MISMATCH})
+        self.assertRaises(makerbot_driver.OutOfOrderError, self.send, machine, 6)
+        self.assertEqual(machine.received, [0, 1, 2, 3, 'query'])
+        self.assertEqual(self.acks, [0])
+
+    def test_late_response(self):
+        # The response of the packet after the failed one comes after the
+        # drain gave up, and before the one of the resync query : the
+        # priority packets sent next still know which responses come first
+        timeout = makerbot_driver.timeout_length
+        makerbot_driver.timeout_length = 0.05
+        try:
+            machine = FakeMachine({(1, 0) : CRC_MISMATCH, (2, 0) : (OVERFLOW, 0.08)})
+            writer = makerbot_driver.Writer.StreamWriter(machine, threading.Condition())
+            writer.send_packets([action(i) for i in range(4)], 2)
+        finally:
+            makerbot_driver.timeout_length = timeout
+        self.assertEqual(machine.received, [0, 1, 2, 'query', 1, 2, 3])
+        self.assertEqual(writer._stream_read, writer._stream_written)
+
+    def test_out_of_order_stop(self):
+        # The failed packet is reported, and the stream is in step to stop
+        # the machine and read its position
+        machine = FakeMachine({(2, 0) : CRC_MISMATCH})
+        writer = makerbot_driver.Writer.StreamWriter(machine, threading.Condition())
+        bot = makerbot_driver.s3g()
+        bot.writer = writer
+        try:
+            writer.send_packets([action(i) for i in range(6)], 3)
+            self.fail("OutOfOrderError not raised")
+        except makerbot_driver.OutOfOrderError as e:
+            self.assertEqual(e.index, 2)
+        bot.extended_stop(True, True)
+        self.assertEqual(bot.get_available_buffer_size(), 512)
+        self.assertEqual(machine.received[-2:], ['stop', 'query'])
+
+
+
+class PriorityTest(unittest.TestCase):
+    def setUp(self):
+        self.machine = FakeMachine(delay=0.002)
+        self.writer = makerbot_driver.Writer.StreamWriter(self.machine, threading.Condition())
+        self.bot = makerbot_driver.s3g()
+        self.bot.writer = self.writer
+
+    def test_stop_from_another_thread(self):
+        packets = [action(i % 256) for i in range(1000)]
+        result = []
+        def stream():
+            try:
+                self.writer.send_packets(packets, 4)
+            except makerbot_driver.PreemptedError:
+                result.append('preempted')
+        thread = threading.Thread(target=stream)
+        thread.start()
+        time.sleep(0.05)
+        self.bot.extended_stop(True, True)
+        thread.join()
+        self.assertEqual(result, ['preempted'])
+        # No packet follows the stop, and the responses are in step
+        self.assertEqual(self.machine.received[-1], 'stop')
+        self.assertEqual(self.bot.get_available_buffer_size(), 512)
+
+    def test_stop_from_callback(self):
+        def callback(i):
+            if i == 0:
+                self.bot.extended_stop(True, True)
+        packets = [action(i) for i in range(6)]
+        self.assertRaises(makerbot_driver.PreemptedError, self.writer.send_packets, packets, 3, callback)
+        self.assertEqual(self.machine.received, [0, 1, 2, 'stop'])
+        self.assertEqual(self.bot.get_available_buffer_size(), 512)
+
+
+if __name__ == "__main__":
+    unittest.main()
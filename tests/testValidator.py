@@ -0,0 +1,39 @@
+import unittest
+import Toolpath
+import Validator
+
+amplitude = {'x' : 190, 'y' : 43, 'z' : 100}
+
+
+def square(x, y, size, depth):
+    toolpath = Toolpath.Toolpath()
+    toolpath.appendZ(2)
+    toolpath.appendXY(x, y)
+    toolpath.appendZ(depth)
+    for px, py in [(x + size, y), (x + size, y + size), (x, y + size), (x, y)]:
+        toolpath.appendXY(px, py)
+    toolpath.appendZ(2)
+    return toolpath
+
+
+class ValidateLayerTest(unittest.TestCase):
+    def test_placeholder_position_before_first_move(self):
+        # The first Z order holds x = y = 0, away from the board
+        toolpath = square(100, 30, 5, -1)
+        offset = {'x' : -90, 'y' : -25}
+        self.assertIsNone(Validator.validateLayer("F.Cu", toolpath, offset, False, 71, None, amplitude))
+
+    def test_first_violation(self):
+        toolpath = square(100, 30, 100, -1)
+        violation = Validator.validateLayer("F.Cu", toolpath, {'x' : 0, 'y' : 0}, False, 71, None, amplitude)
+        self.assertEqual((violation.order, violation.axis), (3, 'x'))
+
+    def test_depth(self):
+        toolpath = square(10, 10, 5, -1)
+        self.assertIsNone(Validator.validateLayer("F.Cu", toolpath, {'x' : 0, 'y' : 0}, False, 71, 99, amplitude))
+        violation = Validator.validateLayer("F.Cu", toolpath, {'x' : 0, 'y' : 0}, False, 71, 99.5, amplitude)
+        self.assertEqual((violation.order, violation.axis), (2, 'z'))
+
+
+if __name__ == "__main__":
+    unittest.main()